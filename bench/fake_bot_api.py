@@ -0,0 +1,188 @@
+import argparse
+import itertools
+import json
+import queue
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class FakeBotApi:
+    # Методы, которые Telegram ограничивает по частоте отправки
+    LIMITED_METHODS = {'sendMessage', 'editMessageText', 'sendPhoto', 'sendDocument', 'copyMessage', 'forwardMessage'}
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, global_rate=30, global_burst=30,
+                 chat_rate=1, chat_burst=3, error_rate=0.0, blocked_chats=()):
+        self.latency = latency
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.error_rate = error_rate
+        self.blocked_chats = set(blocked_chats)
+        self.lock = threading.Lock()
+        self.calls = []
+        self.updates = queue.Queue()
+        self.message_ids = itertools.count(1000)
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def api_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/bot{{0}}/{{1}}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-bot-api', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def push_update(self, update):
+        self.updates.put(update)
+
+    def count(self, method=None, status=None):
+        with self.lock:
+            return sum(1 for call in self.calls
+                       if (method is None or call[1] == method) and (status is None or call[3] == status))
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def make_handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Заголовки и тело уходят отдельными пакетами, без этого каждый ответ ждёт delayed ACK
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                self.handle_call()
+
+            def do_POST(self):
+                self.handle_call()
+
+            def handle_call(self):
+                parts = urlsplit(self.path)
+                method = parts.path.rsplit('/', 1)[-1]
+                params = dict(parse_qsl(parts.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length).decode('utf-8')
+                    if self.headers.get('Content-Type', '').startswith('application/json'):
+                        params.update(json.loads(body))
+                    else:
+                        params.update(parse_qsl(body))
+                status, payload = api.dispatch(method, params)
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def dispatch(self, method, params):
+        started = time.monotonic()
+        status, payload = self.respond(method, params)
+        with self.lock:
+            self.calls.append((started, method, params, status))
+        return status, payload
+
+    def respond(self, method, params):
+        if method == 'getUpdates':
+            return 200, {'ok': True, 'result': self.get_updates(params)}
+        if self.latency:
+            time.sleep(self.latency)
+        chat_id = params.get('chat_id')
+        if method in self.LIMITED_METHODS:
+            retry_after = self.take_send_token(chat_id)
+            if retry_after:
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': f'Too Many Requests: retry after {retry_after}',
+                             'parameters': {'retry_after': retry_after}}
+            if chat_id is not None and str(chat_id) in self.blocked_chats:
+                return 403, {'ok': False, 'error_code': 403, 'description': 'Forbidden: bot was blocked by the user'}
+        return 200, {'ok': True, 'result': self.result(method, params)}
+
+    def take_send_token(self, chat_id):
+        with self.lock:
+            if self.error_rate and random.random() < self.error_rate:
+                return 1
+            wait = self.global_bucket.take()
+            if chat_id is not None and not wait:
+                bucket = self.chat_buckets.get(chat_id)
+                if bucket is None:
+                    bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                wait = bucket.take()
+                if wait:
+                    self.global_bucket.tokens += 1
+        return int(wait) + 1 if wait else 0
+
+    def get_updates(self, params):
+        timeout = float(params.get('timeout') or 0)
+        limit = int(params.get('limit') or 100)
+        result = []
+        try:
+            result.append(self.updates.get(timeout=timeout) if timeout else self.updates.get_nowait())
+            while len(result) < limit:
+                result.append(self.updates.get_nowait())
+        except queue.Empty:
+            pass
+        return result
+
+    def result(self, method, params):
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(params.get('chat_id', 0))
+            message_id = int(params['message_id']) if 'message_id' in params else next(self.message_ids)
+            return {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                    'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(params.get('user_id', 0)), 'is_bot': False, 'first_name': 'User'}}
+        if method == 'getMe':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in for the Telegram Bot API')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+    api = FakeBotApi(port=args.port, latency=args.latency, error_rate=args.error_rate).start()
+    print(f'Fake Bot API on {api.api_url}')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        api.stop()
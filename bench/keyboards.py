@@ -0,0 +1,45 @@
+import os
+import sys
+import timeit
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARK')
+os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/benchmark')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from telebot import apihelper
+
+import main
+
+NUMBER = int(os.environ.get('BENCH_NUMBER', '2000'))
+
+def rebuild_main_menu():
+    return apihelper._convert_markup(main.build_main_menu_markup(list(main.catalog.topics.values()), True))
+
+def cached_main_menu():
+    return apihelper._convert_markup(main.catalog.keyboards['main_trial'])
+
+def rebuild_topic_menu():
+    return apihelper._convert_markup(main.build_topic_markup(main.catalog.topics['topic_5']))
+
+def cached_topic_menu():
+    return apihelper._convert_markup(main.catalog.keyboards['topics']['topic_5'])
+
+def rebuild_content_menu():
+    return apihelper._convert_markup(main.build_content_markup(main.catalog.topics['topic_5']))
+
+def cached_content_menu():
+    return apihelper._convert_markup(main.catalog.keyboards['content']['topic_5'])
+
+def measure(func):
+    return min(timeit.repeat(func, number=NUMBER, repeat=5)) / NUMBER * 1e6
+
+if __name__ == '__main__':
+    assert rebuild_topic_menu() == cached_topic_menu()
+    print(f'{"keyboard":<16}{"rebuild, µs":>14}{"cached, µs":>14}{"saved, µs":>14}')
+    for name, rebuild, cached in [
+        ('main menu', rebuild_main_menu, cached_main_menu),
+        ('topic_5 menu', rebuild_topic_menu, cached_topic_menu),
+        ('content menu', rebuild_content_menu, cached_content_menu),
+    ]:
+        before, after = measure(rebuild), measure(cached)
+        print(f'{name:<16}{before:>14.1f}{after:>14.2f}{before - after:>14.1f}')
@@ -0,0 +1,318 @@
+import argparse
+import json
+import os
+import queue
+import random
+import resource
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import quote
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2
+
+from fake_bot_api import FakeBotApi
+from local_postgres import LocalPostgres
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def main_args():
+    parser = argparse.ArgumentParser(description='Replay synthetic updates through the webhook and polling paths')
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--warmup-users', type=int, default=20, help='users replayed before measuring')
+    parser.add_argument('--mode', choices=('webhook', 'polling', 'both'), default='both')
+    parser.add_argument('--concurrency', type=int, default=8, help='parallel webhook requests')
+    parser.add_argument('--think-time', type=float, default=0.0, help='pause between a reply and the next tap of a user, sec')
+    parser.add_argument('--latency', type=float, default=0.005, help='fake Bot API latency, sec')
+    parser.add_argument('--send-rate', type=float, default=1000, help='SEND_GLOBAL_RATE for the bot and the fake API')
+    parser.add_argument('--chat-rate', type=float, default=100, help='SEND_CHAT_RATE for the bot and the fake API')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of extra 429 answers')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--database-url', default=os.environ.get('BENCH_DATABASE_URL'))
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative regression of throughput and latency')
+    return parser.parse_args()
+
+def with_search_path(url, schema):
+    # Отдельная схема, чтобы не задеть таблицы в общей базе
+    separator = '&' if '?' in url else '?'
+    return f'{url}{separator}options={quote(f"-c search_path={schema}")}'
+
+def user_session(rng, topics):
+    # Действия одного пользователя по порядку: /start, пробный период, прогулка по меню
+    session = [('text', '/start')]
+    if rng.random() < 0.7:
+        session.append(('data', 'a'))
+    for _ in range(rng.randint(3, 8)):
+        topic = rng.choice(topics)
+        session.append(('data', f't:{topic.number}'))
+        for _ in range(rng.randint(0, 3)):
+            session.append(('data', f'c:{topic.number}:{rng.randint(1, len(topic.items))}'))
+        session.append(('data', 'm'))
+    if rng.random() < 0.2:
+        session.append(('data', 'i'))
+    return session
+
+def build_sessions(users, first_user_id, first_update_id, seed, topics):
+    rng = random.Random(seed)
+    sessions = []
+    update_id = first_update_id
+    for i in range(users):
+        session = []
+        for kind, value in user_session(rng, topics):
+            session.append(make_update(update_id, first_user_id + i, kind, value))
+            update_id += 1
+        sessions.append(session)
+    return sessions
+
+class SessionReplay:
+    # Как живой пользователь, сессия отправляет следующее нажатие только после ответа на предыдущее,
+    # иначе склейка правок выбросила бы почти все editMessageText
+    def __init__(self, sessions, think_time, seed):
+        self.think_time = think_time
+        self.total = sum(len(session) for session in sessions)
+        self.following = {}
+        for session in sessions:
+            for update, next_update in zip(session, session[1:]):
+                self.following[update['update_id']] = next_update
+        self.ready = queue.Queue()
+        first = [session[0] for session in sessions if session]
+        random.Random(seed).shuffle(first)
+        for update in first:
+            self.ready.put(update)
+        self.stopped = threading.Event()
+
+    def on_done(self, trace):
+        next_update = self.following.pop(trace['update_id'], None)
+        if next_update is None:
+            return
+        if self.think_time:
+            threading.Timer(self.think_time, self.ready.put, (next_update,)).start()
+        else:
+            self.ready.put(next_update)
+
+    def updates(self):
+        while not self.stopped.is_set():
+            try:
+                yield self.ready.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+def make_update(update_id, user_id, kind, value):
+    user = {'id': user_id, 'is_bot': False, 'first_name': 'Bench'}
+    message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}, 'from': user}
+    if kind == 'text':
+        message.update(text=value, entities=[{'type': 'bot_command', 'offset': 0, 'length': len(value)}])
+        return {'update_id': update_id, 'message': message}
+    callback = {'id': f'{update_id}', 'from': user, 'chat_instance': '1', 'data': value, 'message': dict(message, text='menu')}
+    return {'update_id': update_id, 'callback_query': callback}
+
+def percentile(values, share):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+
+def wait_processed(bot, expected, timeout=300):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        stats = bot.get_dispatch_stats()
+        if stats['processed'] + stats['failed'] >= expected:
+            return
+        time.sleep(0.01)
+    raise TimeoutError(f'Обработано {stats["processed"] + stats["failed"]} из {expected} обновлений')
+
+def replay_webhook(bot, replay, concurrency):
+    rejected = []
+
+    def sender():
+        client = bot.app.test_client()
+        for update in replay.updates():
+            body = json.dumps(update)
+            # Как и Telegram, повторяем доставку, если очередь переполнена
+            while client.post(bot.WEBHOOK_URL_PATH, data=body, content_type='application/json').status_code == 503:
+                rejected.append(1)
+                time.sleep(0.05)
+
+    threads = [threading.Thread(target=sender, daemon=True) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    return threads, rejected
+
+def replay_polling(bot, api, replay):
+    def feeder():
+        for update in replay.updates():
+            api.push_update(update)
+
+    if not getattr(bot, 'polling_started', False):
+        threading.Thread(target=bot.run_polling, name='bench-polling', daemon=True).start()
+        bot.polling_started = True
+    thread = threading.Thread(target=feeder, daemon=True)
+    thread.start()
+    return [thread], []
+
+def run_mode(mode, bot, api, sessions, args):
+    replay = SessionReplay(sessions, args.think_time, args.seed)
+    traces = []
+    bot.trace_observers[:] = [traces.append, replay.on_done]
+    before = bot.get_dispatch_stats()
+    api.reset()
+    rss_before = rss_mb()
+    started = time.monotonic()
+    if mode == 'webhook':
+        threads, rejected = replay_webhook(bot, replay, args.concurrency)
+    else:
+        threads, rejected = replay_polling(bot, api, replay)
+    wait_processed(bot, before['processed'] + before['failed'] + replay.total)
+    elapsed = time.monotonic() - started
+    replay.stopped.set()
+    for thread in threads:
+        thread.join()
+    bot.flush_events()
+    after = bot.get_dispatch_stats()
+
+    handlers = {}
+    for trace in traces:
+        handlers.setdefault(trace['handler'], []).append(trace)
+    return {
+        'updates': replay.total,
+        'elapsed': round(elapsed, 3),
+        'updates_per_sec': round(replay.total / elapsed, 1),
+        'failed': after['failed'] - before['failed'],
+        'rejected': len(rejected),
+        'db_queries_per_update': round(sum(t['db'] for t in traces) / max(1, len(traces)), 2),
+        'api_calls_per_update': round(sum(t['api'] for t in traces) / max(1, len(traces)), 2),
+        'api_429': api.count(status=429),
+        'rss_mb': round(rss_mb(), 1),
+        'rss_growth_mb': round(rss_mb() - rss_before, 1),
+        'handlers': {
+            handler: {
+                'count': len(items),
+                'p50_ms': round(percentile([t['duration'] for t in items], 0.50) * 1000, 2),
+                'p95_ms': round(percentile([t['duration'] for t in items], 0.95) * 1000, 2),
+                'p99_ms': round(percentile([t['duration'] for t in items], 0.99) * 1000, 2),
+                'db_queries': round(sum(t['db'] for t in items) / len(items), 2),
+                'api_calls': round(sum(t['api'] for t in items) / len(items), 2),
+            }
+            for handler, items in sorted(handlers.items())
+        },
+    }
+
+def print_report(mode, result):
+    print(f'\n=== {mode} ===')
+    print(f'Обновлений: {result["updates"]} за {result["elapsed"]} сек. ({result["updates_per_sec"]} в сек.), '
+          f'ошибок: {result["failed"]}, отказов очереди: {result["rejected"]}, ответов 429: {result["api_429"]}')
+    print(f'На обновление: запросов к базе {result["db_queries_per_update"]}, к API {result["api_calls_per_update"]}')
+    print(f'Память: {result["rss_mb"]} МБ (+{result["rss_growth_mb"]} МБ за прогон)')
+    print(f'{"обработчик":<26}{"кол-во":>8}{"p50 мс":>9}{"p95 мс":>9}{"p99 мс":>9}{"база":>7}{"API":>7}')
+    for handler, row in result['handlers'].items():
+        print(f'{handler:<26}{row["count"]:>8}{row["p50_ms"]:>9}{row["p95_ms"]:>9}{row["p99_ms"]:>9}'
+              f'{row["db_queries"]:>7}{row["api_calls"]:>7}')
+
+def compare(results, baseline, tolerance):
+    # Больше — хуже для всего, кроме пропускной способности
+    regressions = []
+
+    def check(name, current, previous, higher_is_better=False, slack=0.0):
+        if previous is None:
+            return
+        if higher_is_better:
+            worse = current < previous * (1 - tolerance)
+        else:
+            worse = current > previous * (1 + tolerance) + slack
+        if worse:
+            regressions.append(f'{name}: {previous} → {current}')
+
+    for mode, result in results.items():
+        previous = baseline.get('modes', {}).get(mode)
+        if previous is None:
+            continue
+        check(f'{mode} updates/sec', result['updates_per_sec'], previous['updates_per_sec'], higher_is_better=True)
+        check(f'{mode} db/update', result['db_queries_per_update'], previous['db_queries_per_update'], slack=0.05)
+        check(f'{mode} api/update', result['api_calls_per_update'], previous['api_calls_per_update'], slack=0.05)
+        for handler, row in result['handlers'].items():
+            old = previous['handlers'].get(handler)
+            if old:
+                # Хвосты на общей машине слишком шумные, поэтому сравниваем медиану; миллисекунда запаса — для быстрых обработчиков
+                check(f'{mode} {handler} p50', row['p50_ms'], old['p50_ms'], slack=1.0)
+    return regressions
+
+if __name__ == '__main__':
+    args = main_args()
+    api = FakeBotApi(latency=args.latency, global_rate=args.send_rate, global_burst=args.send_rate,
+                     chat_rate=args.chat_rate, chat_burst=max(3, args.chat_rate), error_rate=args.error_rate).start()
+    postgres = None
+    database_url = args.database_url
+    if not database_url:
+        postgres = LocalPostgres().start()
+        database_url = postgres.url
+    schema = f'bench_{uuid.uuid4().hex[:8]}'
+    with psycopg2.connect(database_url) as conn, conn.cursor() as cur:
+        cur.execute(f'CREATE SCHEMA {schema}')
+
+    os.environ.update({
+        'TELEGRAM_API_URL': api.api_url,
+        'TELEGRAM_BOT_TOKEN': '123456:BENCHMARK',
+        'DATABASE_URL': with_search_path(database_url, schema),
+        'WEBHOOK_HOST': 'bench.local',
+        'CHANNEL_ID': '@bench_channel',
+        'SEND_GLOBAL_RATE': str(args.send_rate),
+        'SEND_CHAT_RATE': str(args.chat_rate),
+        'POLLING_TIMEOUT': '1',
+        'METRICS_PORT': '0',
+        'SLOW_TRACE_SAMPLE_RATE': '0',
+    })
+    for number in range(1, 10):
+        os.environ.setdefault(f'TOP{number}', f'https://example.com/topic/{number}')
+    import main as bot
+
+    results = {}
+    try:
+        bot.init_db()
+        bot.refresh_subscriptions()
+        bot.start_analytics()
+        bot.start_dispatcher()
+        topics = list(bot.catalog.topics.values())
+        # Первые соединения с базой и API не должны попадать в замеры
+        run_mode('webhook', bot, api, build_sessions(args.warmup_users, 1, 1, args.seed, topics), args)
+        modes = ('webhook', 'polling') if args.mode == 'both' else (args.mode,)
+        for i, mode in enumerate(modes):
+            # У каждого режима свои пользователи, чтобы кэши и пробные периоды не переходили между прогонами
+            sessions = build_sessions(args.users, 1_000_000 * (i + 1), 1_000_000 * (i + 1), args.seed + i, topics)
+            results[mode] = run_mode(mode, bot, api, sessions, args)
+            print_report(mode, results[mode])
+        print(f'\nПик памяти процесса: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} МБ')
+    finally:
+        bot.close_db_pool()
+        with psycopg2.connect(database_url) as conn, conn.cursor() as cur:
+            cur.execute(f'DROP SCHEMA {schema} CASCADE')
+        if postgres is not None:
+            postgres.stop()
+
+    report = {'params': {key: value for key, value in vars(args).items() if key not in ('database_url', 'baseline', 'save_baseline', 'tolerance')},
+              'modes': results}
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'Базовые значения сохранены в {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != report['params']:
+            print('⚠️ Параметры прогона отличаются от базовых, сравнение может быть неточным')
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('\n❌ Регрессии относительно базовых значений:')
+            for line in regressions:
+                print(f'   {line}')
+            sys.exit(1)
+        print('\n✅ Регрессий относительно базовых значений нет')
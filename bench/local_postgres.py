@@ -0,0 +1,56 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+
+class LocalPostgres:
+    # Одноразовый кластер во временном каталоге, доступный только через unix-сокет
+    def __init__(self, bin_dir=None):
+        self.bin_dir = bin_dir or os.environ.get('PG_BIN')
+        self.data_dir = None
+        self.port = None
+
+    def binary(self, name):
+        if self.bin_dir:
+            return os.path.join(self.bin_dir, name)
+        path = shutil.which(name)
+        if path is None:
+            raise RuntimeError(f'{name} не найден: установите PostgreSQL, укажите PG_BIN или BENCH_DATABASE_URL')
+        return path
+
+    @property
+    def url(self):
+        return f'postgresql://postgres@/postgres?host={self.data_dir}&port={self.port}'
+
+    def start(self):
+        self.data_dir = tempfile.mkdtemp(prefix='bench-pg-')
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            self.port = sock.getsockname()[1]
+        try:
+            subprocess.run(
+                [self.binary('initdb'), '-D', self.data_dir, '-U', 'postgres', '-A', 'trust', '--no-sync'],
+                check=True, stdout=subprocess.DEVNULL
+            )
+            options = f"-k {self.data_dir} -p {self.port} -c listen_addresses='' -c fsync=off"
+            subprocess.run(
+                [self.binary('pg_ctl'), '-D', self.data_dir, '-o', options, '-l', os.path.join(self.data_dir, 'log'), '-w', 'start'],
+                check=True, stdout=subprocess.DEVNULL
+            )
+        except Exception:
+            shutil.rmtree(self.data_dir, ignore_errors=True)
+            self.data_dir = None
+            raise
+        return self
+
+    def stop(self):
+        if self.data_dir is None:
+            return
+        subprocess.run(
+            [self.binary('pg_ctl'), '-D', self.data_dir, '-m', 'immediate', '-w', 'stop'],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+        self.data_dir = None
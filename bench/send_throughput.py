@@ -0,0 +1,68 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from fake_bot_api import FakeBotApi
+
+def main_args():
+    parser = argparse.ArgumentParser(description='Send scheduler throughput against the fake Bot API')
+    parser.add_argument('--messages', type=int, default=300)
+    parser.add_argument('--chats', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = main_args()
+    api = FakeBotApi(latency=args.latency, error_rate=args.error_rate).start()
+    os.environ['TELEGRAM_API_URL'] = api.api_url
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:BENCHMARK')
+    os.environ.setdefault('DATABASE_URL', 'postgresql://localhost/benchmark')
+    import main
+
+    jobs = iter(range(args.messages))
+    jobs_lock = threading.Lock()
+    failures = []
+    interactive_latency = []
+
+    def background_sender():
+        while True:
+            with jobs_lock:
+                i = next(jobs, None)
+            if i is None:
+                return
+            try:
+                main.send_message(10_000 + i % args.chats, f'Сообщение {i}', priority=main.PRIORITY_BACKGROUND)
+            except Exception as e:
+                failures.append(e)
+
+    def interactive_sender():
+        # Пользователь листает меню, пока идёт фоновая рассылка
+        for i in range(10):
+            started = time.monotonic()
+            main.edit_message(f'Экран {i}', 1, 1)
+            interactive_latency.append(time.monotonic() - started)
+            time.sleep(1)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=background_sender) for _ in range(args.threads)]
+    interactive = threading.Thread(target=interactive_sender)
+    for thread in threads + [interactive]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # Интерактивный поток всегда работает около 10 секунд, в скорость рассылки его не включаем
+    elapsed = time.monotonic() - started
+    interactive.join()
+    api.stop()
+
+    sent = api.count('sendMessage', 200)
+    print(f'Отправлено: {sent} из {args.messages} за {elapsed:.1f} сек. ({sent / elapsed:.1f} сообщений/сек, лимит {main.SEND_GLOBAL_RATE:g})')
+    print(f'Ответов 429: {api.count(status=429)}, ошибок: {len(failures)}')
+    print(f'Задержка интерактивных правок: макс. {max(interactive_latency) * 1000:.0f} мс')
@@ -1,28 +1,42 @@
 import telebot
 from telebot import types
 import psycopg2
+import psycopg2.extras
+from psycopg2 import pool as pg_pool
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+from psycopg2 import sql
 import os
-from datetime import datetime, timedelta
+import time
+import atexit
+import threading
+import io
+import sys
+import select
+import json
+import signal
+import random
+import bisect
+import functools
+import queue
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import flask
 
 TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
-top1 = os.environ.get('TOP1')
-top2 = os.environ.get('TOP2')
-top3 = os.environ.get('TOP3')
-top4 = os.environ.get('TOP4')
-top5 = os.environ.get('TOP5')
-top6 = os.environ.get('TOP6')
-top7 = os.environ.get('TOP7')
-top8 = os.environ.get('TOP8')
-top9 = os.environ.get('TOP9')
-
 manager = os.environ.get('MANAGER')
 channel_id = os.environ.get('CHANNEL_ID')
 channel_url = os.environ.get('CHANNEL_URL')
 
-users = [2028669813, 1035549880]
+# Исходный список полного доступа, при первом запуске переносится в таблицу subscriptions
+LEGACY_FULL_ACCESS_USERS = [2028669813, 1035549880]
+ADMIN_IDS = {int(admin_id) for admin_id in os.environ.get('ADMIN_IDS', '').replace(' ', '').split(',') if admin_id}
 
 if not TOKEN:
     raise ValueError("TELEGRAM_BOT_TOKEN environment variable is required")
@@ -30,325 +44,1883 @@ if not TOKEN:
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL environment variable is required")
 
-bot = telebot.TeleBot(TOKEN)
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL')
+if TELEGRAM_API_URL:
+    # Например, http://127.0.0.1:8081/bot{0}/{1} для локального Bot API или тестового сервера
+    telebot.apihelper.API_URL = TELEGRAM_API_URL
+
+# Обработчики выполняются в воркерах диспетчера, собственный пул потоков telebot не нужен
+bot = telebot.TeleBot(TOKEN, threaded=False)
 
 TRIAL_DURATION_DAYS = 1
 
-def get_db_connection():
-    return psycopg2.connect(DATABASE_URL)
+# В этой зоне показываем даты пользователям; старые значения без зоны считаем записанными в TRIAL_LEGACY_TIMEZONE
+DISPLAY_TIMEZONE = ZoneInfo(os.environ.get('DISPLAY_TIMEZONE', 'Europe/Moscow'))
+TRIAL_LEGACY_TIMEZONE = os.environ.get('TRIAL_LEGACY_TIMEZONE', 'UTC')
+
+def now_utc():
+    return datetime.now(timezone.utc)
+
+def format_time(moment):
+    return f'{moment.astimezone(DISPLAY_TIMEZONE):%d.%m.%Y %H:%M}'
+
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def format_metric_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{key}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.definitions = {}
+        self.series = {}
+
+    def define(self, name, kind, help_text, buckets=None):
+        self.definitions[name] = (kind, help_text, buckets)
+        self.series[name] = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            series = self.series[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, labels=(), value=0):
+        with self.lock:
+            self.series[name][labels] = value
+
+    def observe(self, name, labels, value):
+        buckets = self.definitions[name][2]
+        index = bisect.bisect_left(buckets, value)
+        with self.lock:
+            # Счётчики по корзинам без накопления, затем сумма и общее количество
+            state = self.series[name].get(labels)
+            if state is None:
+                state = self.series[name][labels] = [0] * (len(buckets) + 2)
+            if index < len(buckets):
+                state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for name, (kind, help_text, buckets) in self.definitions.items():
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} {kind}')
+                for labels, value in self.series[name].items():
+                    if kind != 'histogram':
+                        lines.append(f'{name}{format_metric_labels(labels)} {value}')
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets, value):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{format_metric_labels(labels + (("le", bound),))} {cumulative}')
+                    lines.append(f'{name}_bucket{format_metric_labels(labels + (("le", "+Inf"),))} {value[-1]}')
+                    lines.append(f'{name}_sum{format_metric_labels(labels)} {value[-2]:.6f}')
+                    lines.append(f'{name}_count{format_metric_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+# Вид замера: (гистограмма длительности, счётчик ошибок, имя метки)
+MEASURE_KINDS = {
+    'handler': ('bot_handler_duration_seconds', 'bot_handler_errors_total', 'handler'),
+    'db': ('bot_db_query_duration_seconds', 'bot_db_query_errors_total', 'helper'),
+    'api': ('bot_api_call_duration_seconds', 'bot_api_call_errors_total', 'method'),
+}
+
+metrics.define('bot_handler_duration_seconds', 'histogram', 'Время работы обработчика', METRICS_BUCKETS)
+metrics.define('bot_handler_errors_total', 'counter', 'Обработчики, завершившиеся исключением')
+metrics.define('bot_db_query_duration_seconds', 'histogram', 'Время запроса к базе по функции, которая его выполняет', METRICS_BUCKETS)
+metrics.define('bot_db_query_errors_total', 'counter', 'Запросы к базе, завершившиеся ошибкой')
+metrics.define('bot_api_call_duration_seconds', 'histogram', 'Время запроса к Telegram Bot API', METRICS_BUCKETS)
+metrics.define('bot_api_call_errors_total', 'counter', 'Запросы к Telegram Bot API, завершившиеся ошибкой')
+metrics.define('bot_update_duration_seconds', 'histogram', 'Полное время обработки обновления', METRICS_BUCKETS)
+metrics.define('bot_update_db_queries', 'histogram', 'Запросов к базе на одно обновление', METRICS_COUNT_BUCKETS)
+metrics.define('bot_update_api_calls', 'histogram', 'Запросов к Bot API на одно обновление', METRICS_COUNT_BUCKETS)
+
+SLOW_UPDATE_SECONDS = float(os.environ.get('SLOW_UPDATE_SECONDS', '1'))
+SLOW_TRACE_SAMPLE_RATE = float(os.environ.get('SLOW_TRACE_SAMPLE_RATE', '1'))
+SLOW_TRACE_LIMIT = int(os.environ.get('SLOW_TRACE_LIMIT', '50'))
+
+trace_local = threading.local()
+slow_traces = deque(maxlen=SLOW_TRACE_LIMIT)
+# Получают каждую завершённую трассировку обновления, например нагрузочный тест
+trace_observers = []
+
+def start_trace(update_id, update_type):
+    trace_local.trace = {
+        'update_id': update_id,
+        'handler': update_type,
+        'started': time.perf_counter(),
+        'db': 0,
+        'api': 0,
+        'spans': [],
+    }
+
+def current_trace():
+    return getattr(trace_local, 'trace', None)
+
+def finish_trace():
+    trace = current_trace()
+    if trace is None:
+        return None
+    trace_local.trace = None
+    duration = trace['duration'] = time.perf_counter() - trace['started']
+    for observer in trace_observers:
+        observer(trace)
+    labels = (('handler', trace['handler']),)
+    metrics.observe('bot_update_duration_seconds', labels, duration)
+    metrics.observe('bot_update_db_queries', labels, trace['db'])
+    metrics.observe('bot_update_api_calls', labels, trace['api'])
+    if duration >= SLOW_UPDATE_SECONDS and random.random() < SLOW_TRACE_SAMPLE_RATE:
+        report = {
+            'update_id': trace['update_id'],
+            'handler': trace['handler'],
+            'at': now_utc().isoformat(),
+            'duration': round(duration, 4),
+            'db_queries': trace['db'],
+            'api_calls': trace['api'],
+            'spans': [
+                {'offset': round(offset, 4), 'kind': kind, 'name': name, 'duration': round(elapsed, 4), 'failed': failed}
+                for offset, kind, name, elapsed, failed in sorted(trace['spans'])
+            ],
+        }
+        slow_traces.append(report)
+        print_slow_trace(report)
+    return duration
+
+def print_slow_trace(report):
+    lines = [
+        f"🐢 Медленное обновление {report['update_id']} ({report['handler']}): {report['duration']:.3f} сек, "
+        f"запросов к базе {report['db_queries']}, к API {report['api_calls']}"
+    ]
+    for span in report['spans']:
+        mark = ' ❌' if span['failed'] else ''
+        lines.append(f"   +{span['offset']:.3f} {span['kind']:<7} {span['name']:<28} {span['duration']:.3f}{mark}")
+    print('\n'.join(lines))
+
+@contextmanager
+def measure(kind, name):
+    histogram, errors, label = MEASURE_KINDS[kind]
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        labels = ((label, name),)
+        metrics.observe(histogram, labels, elapsed)
+        if failed:
+            metrics.inc(errors, labels)
+        trace = current_trace()
+        if trace is not None:
+            if kind in ('db', 'api'):
+                trace[kind] += 1
+            trace['spans'].append((started - trace['started'], kind, name, elapsed, failed))
+
+def instrumented(handler):
+    @functools.wraps(handler)
+    def wrapper(*args, **kwargs):
+        trace = current_trace()
+        if trace is not None:
+            trace['handler'] = handler.__name__
+        with measure('handler', handler.__name__):
+            return handler(*args, **kwargs)
+    return wrapper
+
+# chat_member приходит только если запросить его явно, а бот является админом канала
+ALLOWED_UPDATES = ['message', 'callback_query', 'chat_member']
+
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', '10'))
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_HEALTHCHECK_INTERVAL', '30'))
+
+class TimedCursor(psycopg2.extensions.cursor):
+    # Каждый запрос попадает в метрики с именем функции, открывшей курсор
+    helper = 'other'
+
+    def execute(self, query, vars=None):
+        with measure('db', self.helper):
+            return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        with measure('db', self.helper):
+            return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        with measure('db', self.helper):
+            return super().copy_expert(sql, file, size)
+
+db_pool = None
+db_pool_lock = threading.Lock()
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+db_last_used = {}
+
+def get_db_pool():
+    global db_pool
+    if db_pool is None:
+        with db_pool_lock:
+            if db_pool is None:
+                db_pool = pg_pool.ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX, DATABASE_URL, cursor_factory=TimedCursor
+                )
+    return db_pool
+
+def close_db_pool():
+    global db_pool
+    with db_pool_lock:
+        if db_pool is not None:
+            db_pool.closeall()
+            db_pool = None
+            db_last_used.clear()
+
+atexit.register(close_db_pool)
+
+def is_connection_alive(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - db_last_used.get(id(conn), 0) < DB_HEALTHCHECK_INTERVAL:
+        return True
+    try:
+        with conn.cursor() as cur:
+            cur.helper = 'healthcheck'
+            cur.execute('SELECT 1')
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+def checkout_connection(pool):
+    # Соединения, которые сервер успел закрыть, выбрасываем и берём новые
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if is_connection_alive(conn):
+            return conn
+        db_last_used.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError('Не удалось получить рабочее соединение с базой данных')
+
+@contextmanager
+def db_connection():
+    if not db_pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+        raise pg_pool.PoolError('Пул соединений исчерпан')
+    try:
+        pool = get_db_pool()
+        conn = checkout_connection(pool)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            broken = broken or bool(conn.closed)
+            if broken:
+                db_last_used.pop(id(conn), None)
+            else:
+                db_last_used[id(conn)] = time.monotonic()
+            pool.putconn(conn, close=broken)
+    finally:
+        db_pool_slots.release()
+
+@contextmanager
+def db_cursor(helper, commit=False):
+    with db_connection() as conn:
+        cur = conn.cursor()
+        # Имя функции, под которым запросы курсора попадают в метрики
+        cur.helper = helper
+        try:
+            yield cur
+            if commit:
+                conn.commit()
+        finally:
+            cur.close()
+
+LEGACY_TIMESTAMP_COLUMNS = (
+    ('trial_users', 'trial_start'),
+    ('trial_users', 'trial_expiry'),
+    ('subscriptions', 'expires_at'),
+    ('subscriptions', 'updated_at'),
+)
+
+def migrate_timestamp_columns(cur):
+    cur.execute(
+        """
+        SELECT table_name, column_name FROM information_schema.columns
+        WHERE table_schema = current_schema() AND data_type = 'timestamp without time zone'
+          AND (table_name, column_name) IN %s
+        """,
+        (LEGACY_TIMESTAMP_COLUMNS,)
+    )
+    for table, column in cur.fetchall():
+        cur.execute(
+            sql.SQL("ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMPTZ USING {column} AT TIME ZONE %s").format(
+                table=sql.Identifier(table), column=sql.Identifier(column)
+            ),
+            (TRIAL_LEGACY_TIMEZONE,)
+        )
+        print(f"✅ {table}.{column} переведён в TIMESTAMPTZ")
+
+def mark_missed_trials(cur):
+    # Напоминание после окончания и уведомление старше окна уже не отправятся: помечаем их,
+    # чтобы такие строки не оставались в частичных индексах навсегда
+    cur.execute("UPDATE trial_users SET reminder_sent_at = now() WHERE reminder_sent_at IS NULL AND trial_expiry <= now()")
+    cur.execute(
+        "UPDATE trial_users SET expired_notified_at = now() WHERE expired_notified_at IS NULL AND trial_expiry <= now() - %s",
+        (timedelta(hours=TRIAL_EXPIRED_LOOKBACK_HOURS),)
+    )
 
 def init_db():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("""
+    with db_cursor('init_db', commit=True) as cur:
+        cur.execute("""
         CREATE TABLE IF NOT EXISTS trial_users (
             user_id BIGINT PRIMARY KEY,
-            trial_start TIMESTAMP NOT NULL,
-            trial_expiry TIMESTAMP NOT NULL,
+            trial_start TIMESTAMPTZ NOT NULL,
+            trial_expiry TIMESTAMPTZ NOT NULL,
             trial_used BOOLEAN DEFAULT TRUE,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    """)
-    conn.commit()
-    cur.close()
-    conn.close()
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id BIGINT PRIMARY KEY,
+            expires_at TIMESTAMPTZ,
+            revoked BOOLEAN NOT NULL DEFAULT FALSE,
+            granted_by BIGINT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+        """)
+        migrate_timestamp_columns(cur)
+        cur.execute("ALTER TABLE trial_users ADD COLUMN IF NOT EXISTS reminder_sent_at TIMESTAMPTZ")
+        cur.execute("ALTER TABLE trial_users ADD COLUMN IF NOT EXISTS expired_notified_at TIMESTAMPTZ")
+        # Частичные индексы содержат только тех, кому ещё не писали; пропущенные уведомления закрывает mark_missed_trials,
+        # поэтому проход по ним не растёт вместе с таблицей
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS trial_users_reminder_idx ON trial_users (trial_expiry) "
+            "WHERE reminder_sent_at IS NULL"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS trial_users_expired_idx ON trial_users (trial_expiry) "
+            "WHERE expired_notified_at IS NULL"
+        )
+        mark_missed_trials(cur)
+        cur.execute("CREATE INDEX IF NOT EXISTS subscriptions_updated_at_idx ON subscriptions (updated_at)")
+        cur.execute("""
+        CREATE OR REPLACE FUNCTION notify_subscriptions_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('subscriptions_changed', NEW.user_id::text);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """)
+        cur.execute("DROP TRIGGER IF EXISTS subscriptions_changed ON subscriptions")
+        cur.execute("""
+        CREATE TRIGGER subscriptions_changed AFTER INSERT OR UPDATE ON subscriptions
+        FOR EACH ROW EXECUTE PROCEDURE notify_subscriptions_changed()
+        """)
+        cur.execute(
+            "INSERT INTO subscriptions (user_id) SELECT unnest(%s::BIGINT[]) ON CONFLICT (user_id) DO NOTHING",
+            (LEGACY_FULL_ACCESS_USERS,)
+        )
+        cur.execute("SELECT to_regclass('bot_users')")
+        bot_users_existed = cur.fetchone()[0] is not None
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS bot_users (
+            user_id BIGINT PRIMARY KEY,
+            first_seen TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            blocked_at TIMESTAMPTZ
+        )
+        """)
+        if not bot_users_existed:
+            # До появления таблицы пользователи оставляли след только в trial_users и subscriptions
+            cur.execute(
+                "INSERT INTO bot_users (user_id) SELECT user_id FROM trial_users "
+                "UNION SELECT user_id FROM subscriptions ON CONFLICT (user_id) DO NOTHING"
+            )
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id SERIAL PRIMARY KEY,
+            text TEXT NOT NULL,
+            created_by BIGINT,
+            admin_chat_id BIGINT,
+            status TEXT NOT NULL DEFAULT 'running',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            finished_at TIMESTAMPTZ
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_events (
+            created_at TIMESTAMPTZ NOT NULL,
+            event TEXT NOT NULL,
+            user_id BIGINT NOT NULL,
+            topic_id TEXT,
+            item INTEGER
+        )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS analytics_events_created_at_idx ON analytics_events USING BRIN (created_at)")
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS analytics_hourly (
+            hour TIMESTAMPTZ NOT NULL,
+            event TEXT NOT NULL,
+            topic_id TEXT NOT NULL DEFAULT '',
+            item INTEGER NOT NULL DEFAULT 0,
+            count BIGINT NOT NULL,
+            PRIMARY KEY (hour, event, topic_id, item)
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            broadcast_id INTEGER NOT NULL REFERENCES broadcasts (id),
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            sent_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (broadcast_id, user_id)
+        )
+        """)
 
 def get_trial_info(user_id):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT trial_start, trial_expiry, trial_used FROM trial_users WHERE user_id = %s",
-        (user_id,)
-    )
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
-    return result
+    with db_cursor('get_trial_info') as cur:
+        cur.execute(
+            "SELECT trial_start, trial_expiry, trial_used FROM trial_users WHERE user_id = %s",
+            (user_id,)
+        )
+        return cur.fetchone()
+
+def start_trial(user_id):
+    # Время берём из базы, чтобы срок не зависел от часов сервера бота
+    with db_cursor('start_trial', commit=True) as cur:
+        cur.execute(
+            """
+            INSERT INTO trial_users (user_id, trial_start, trial_expiry, trial_used)
+            VALUES (%s, now(), now() + %s, TRUE)
+            ON CONFLICT (user_id) DO NOTHING
+            """,
+            (user_id, timedelta(days=TRIAL_DURATION_DAYS))
+        )
+        started = cur.rowcount > 0
+    invalidate_user_state(user_id)
+    return started
+
+class TTLCache:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return default
+            value, expires_at, stored_at = entry
+            if time.monotonic() >= expires_at:
+                return default
+            self.data.move_to_end(key)
+            return value
+
+    def get_stale(self, key, max_age, default=None):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None or time.monotonic() - entry[2] > max_age:
+                return default
+            return entry[0]
+
+    def add(self, key, value, ttl=None):
+        stored_at = time.monotonic()
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is not None and stored_at < entry[1]:
+                return False
+            self.data[key] = (value, stored_at + (self.ttl if ttl is None else ttl), stored_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+            return True
+
+    def set(self, key, value, ttl=None):
+        stored_at = time.monotonic()
+        expires_at = stored_at + (self.ttl if ttl is None else ttl)
+        with self.lock:
+            self.data[key] = (value, expires_at, stored_at)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            self.data.pop(key, None)
 
-def get_trial_remaining(user_id):
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+USER_STATE_CACHE_SIZE = int(os.environ.get('USER_STATE_CACHE_SIZE', '10000'))
+USER_STATE_TTL = float(os.environ.get('USER_STATE_TTL', '60'))
+
+user_state_cache = TTLCache(USER_STATE_CACHE_SIZE, USER_STATE_TTL)
+
+class UserState(namedtuple('UserState', ['user_id', 'access', 'expires_at', 'trial_used'])):
+    __slots__ = ()
+
+    @property
+    def remaining(self):
+        if self.access != 'trial':
+            return None
+        return max(self.expires_at - now_utc(), timedelta(0))
+
+def load_user_state(user_id):
+    if has_full_access(user_id):
+        return UserState(user_id, 'full', get_subscription_expiry(user_id), False)
     trial_info = get_trial_info(user_id)
     if trial_info is None:
-        return None
+        return UserState(user_id, 'none', None, False)
     trial_start, trial_expiry, trial_used = trial_info
-    now = datetime.now()
-    if now >= trial_expiry:
-        return 0
-    return trial_expiry - now
+    if now_utc() < trial_expiry:
+        return UserState(user_id, 'trial', trial_expiry, trial_used)
+    return UserState(user_id, 'expired', trial_expiry, trial_used)
 
-def has_used_trial(user_id):
-    trial_info = get_trial_info(user_id)
-    if trial_info is None:
-        return False
-    return trial_info[2]
+def get_user_state(user_id):
+    state = user_state_cache.get(user_id)
+    if state is None:
+        state = load_user_state(user_id)
+        ttl = USER_STATE_TTL
+        if state.access in ('trial', 'full') and state.expires_at is not None:
+            # Запись должна устареть ровно в момент окончания доступа
+            ttl = max(0, min(ttl, (state.expires_at - now_utc()).total_seconds()))
+        user_state_cache.set(user_id, state, ttl)
+    return state
 
-def start_trial(user_id):
-    if has_used_trial(user_id):
-        return False
-    now = datetime.now()
-    expiry_time = now + timedelta(days=TRIAL_DURATION_DAYS)
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO trial_users (user_id, trial_start, trial_expiry, trial_used)
-        VALUES (%s, %s, %s, TRUE)
-        ON CONFLICT (user_id) DO NOTHING
-        """,
-        (user_id, now, expiry_time)
-    )
-    rows_affected = cur.rowcount
-    conn.commit()
-    cur.close()
-    conn.close()
-    return rows_affected > 0
-
-def has_trial_access(user_id):
-    remaining = get_trial_remaining(user_id)
-    if remaining is None or remaining == 0:
+def invalidate_user_state(user_id):
+    user_state_cache.pop(user_id)
+
+SUBSCRIPTIONS_REFRESH_INTERVAL = float(os.environ.get('SUBSCRIPTIONS_REFRESH_INTERVAL', '60'))
+SUBSCRIPTIONS_SYNC_OVERLAP = timedelta(seconds=30)
+
+# user_id -> срок окончания (None — бессрочно)
+subscribers = {}
+subscribers_lock = threading.Lock()
+subscriptions_synced_at = None
+
+def get_subscription_expiry(user_id):
+    return subscribers.get(user_id)
+
+def has_full_access(user_id):
+    expires_at = subscribers.get(user_id, False)
+    if expires_at is False:
         return False
-    return True
+    return expires_at is None or now_utc() < expires_at
+
+def refresh_subscriptions():
+    global subscriptions_synced_at
+    with db_cursor('refresh_subscriptions') as cur:
+        if subscriptions_synced_at is None:
+            cur.execute("SELECT user_id, expires_at, revoked, updated_at FROM subscriptions")
+        else:
+            # Перекрытие окна ловит транзакции, которые закоммитились позже своего updated_at
+            cur.execute(
+                "SELECT user_id, expires_at, revoked, updated_at FROM subscriptions WHERE updated_at > %s",
+                (subscriptions_synced_at - SUBSCRIPTIONS_SYNC_OVERLAP,)
+            )
+        rows = cur.fetchall()
+    changed = []
+    with subscribers_lock:
+        if subscriptions_synced_at is None:
+            subscribers.clear()
+        for user_id, expires_at, revoked, updated_at in rows:
+            before = subscribers.get(user_id, False)
+            if revoked:
+                subscribers.pop(user_id, None)
+            else:
+                subscribers[user_id] = expires_at
+            if subscribers.get(user_id, False) != before:
+                changed.append(user_id)
+            if subscriptions_synced_at is None or updated_at > subscriptions_synced_at:
+                subscriptions_synced_at = updated_at
+    for user_id in changed:
+        invalidate_user_state(user_id)
+    return len(changed)
+
+def subscriptions_listener():
+    while True:
+        conn = None
+        try:
+            # LISTEN держит соединение постоянно, поэтому оно отдельное, а не из пула
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+            with conn.cursor() as cur:
+                cur.execute('LISTEN subscriptions_changed')
+            refresh_subscriptions()
+            while True:
+                if select.select([conn], [], [], SUBSCRIPTIONS_REFRESH_INTERVAL) != ([], [], []):
+                    conn.poll()
+                    conn.notifies.clear()
+                refresh_subscriptions()
+        except Exception as e:
+            print(f"❌ Ошибка синхронизации подписок: {e}")
+            time.sleep(5)
+        finally:
+            if conn is not None:
+                conn.close()
+
+def start_subscriptions_sync():
+    threading.Thread(target=subscriptions_listener, name='subscriptions-sync', daemon=True).start()
 
-def has_access(user_id, topic_id=None):
-    if user_id in users:
+def grant_subscription(user_id, days, granted_by):
+    expires_at = now_utc() + timedelta(days=days) if days is not None else None
+    with db_cursor('grant_subscription', commit=True) as cur:
+        cur.execute(
+            """
+            INSERT INTO subscriptions (user_id, expires_at, revoked, granted_by, updated_at)
+            VALUES (%s, %s, FALSE, %s, CURRENT_TIMESTAMP)
+            ON CONFLICT (user_id) DO UPDATE
+            SET expires_at = EXCLUDED.expires_at, revoked = FALSE,
+                granted_by = EXCLUDED.granted_by, updated_at = CURRENT_TIMESTAMP
+            """,
+            (user_id, expires_at, granted_by)
+        )
+    refresh_subscriptions()
+    return expires_at
+
+def revoke_subscription(user_id):
+    with db_cursor('revoke_subscription', commit=True) as cur:
+        cur.execute(
+            "UPDATE subscriptions SET revoked = TRUE, updated_at = CURRENT_TIMESTAMP WHERE user_id = %s AND NOT revoked",
+            (user_id,)
+        )
+        revoked = cur.rowcount > 0
+    refresh_subscriptions()
+    return revoked
+
+def has_access(state, topic_id=None):
+    if state.access == 'full':
         return 'full'
-    if has_trial_access(user_id) and topic_id == 'topic_1':
+    if state.access == 'trial' and topic_id == 'topic_1':
         return 'trial'
     return None
 
-def get_status_text(user_id):
-    if user_id in users:
+def get_status_text(state):
+    if state.access == 'full':
+        if state.expires_at is not None:
+            return f'⚡ <b>Статус подписки</b> - <code>Активная</code>\n\n📅 Действует до: <code>{format_time(state.expires_at)}</code>'
         return '⚡ <b>Статус подписки</b> - <code>Активная</code>'
-    remaining = get_trial_remaining(user_id)
-    if remaining and remaining != 0:
+    if state.access == 'trial':
+        remaining = state.remaining
         hours = int(remaining.total_seconds() // 3600)
         minutes = int((remaining.total_seconds() % 3600) // 60) 
         return f'<b>🎁 Статус подписки</b> - <code>Пробная</code>\n\n📚 Доступный раздел: <code>👶 Эмбриология</code>\n🕧 Осталось: <code>{hours} ч. {minutes} мин.</code>'
-    if has_used_trial(user_id):
+    if state.trial_used:
         return f'❌ <b>Статус подписки</b> - <code>Неактивная</code>\n\n⭐ Для полного доступа обратитесь к {manager}'
     return f'🔓 Нажмите кнопку ниже, чтобы активировать пробный период на 24 часа!\n📚 Будет доступен раздел: 👶 Эмбриология'
 
-def get_main_menu_markup(user_id):
-    is_subscribed = user_id in users
-    markup = types.InlineKeyboardMarkup()
-    if not is_subscribed and not has_trial_access(user_id) and not has_used_trial(user_id):
-        markup.row(types.InlineKeyboardButton('🎫 Активировать пробный период', callback_data='activate_trial'))
-    buttons = [
-        ('👶 Эмбриология', 'topic_1'), ('💈 Эпителиальные ткани', 'topic_2'),
-        ('🩸 Кровь и ткани внутренней среды', 'topic_3'),
-        ('🦴 Волокнистая, скелетная и жировая ткани', 'topic_4'),
-        ('👅 Мышечные и нервные ткани', 'topic_5'),
-        ('💉 ССС, органы кроветворения', 'topic_6'),
-        ('👄 Эндокринная система', 'topic_7'),
-        ('👃 Пищеварительная и дыхательная', 'topic_8'),
-        ('🔞 Мочевыделительная и половая', 'topic_9'),
-        ('ℹ️ Информация', 'topic_10'),
-    ]
-    markup.row(types.InlineKeyboardButton(buttons[0][0], callback_data=buttons[0][1]),
-               types.InlineKeyboardButton(buttons[1][0], callback_data=buttons[1][1]))
-    for text, data in buttons[2:]:
-        markup.row(types.InlineKeyboardButton(text, callback_data=data))
-    return markup
+def get_main_menu_markup(state):
+    if state.access == 'none' and not state.trial_used:
+        return catalog.keyboards['main_trial']
+    return catalog.keyboards['main']
+
+SUBSCRIBED_STATUSES = ('member', 'administrator', 'creator')
 
-def is_subscribed(user_id):
+SUB_CACHE_SIZE = int(os.environ.get('SUB_CACHE_SIZE', '10000'))
+SUB_CACHE_POSITIVE_TTL = float(os.environ.get('SUB_CACHE_POSITIVE_TTL', '600'))
+SUB_CACHE_NEGATIVE_TTL = float(os.environ.get('SUB_CACHE_NEGATIVE_TTL', '30'))
+SUB_CACHE_STALE_MAX_AGE = float(os.environ.get('SUB_CACHE_STALE_MAX_AGE', '3600'))
+
+membership_cache = TTLCache(SUB_CACHE_SIZE, SUB_CACHE_POSITIVE_TTL)
+
+def remember_membership(user_id, subscribed):
+    ttl = SUB_CACHE_POSITIVE_TTL if subscribed else SUB_CACHE_NEGATIVE_TTL
+    membership_cache.set(user_id, subscribed, ttl)
+
+def is_subscribed(user_id, refresh=False):
     if not channel_id:
         return True 
-    if user_id in users:
+    if has_full_access(user_id):
         return True
-    
+    if not refresh:
+        cached = membership_cache.get(user_id)
+        if cached is not None:
+            return cached
     try:
-        status = bot.get_chat_member(channel_id, user_id).status
-        return status in ['member', 'administrator', 'creator']
+        with measure('api', 'get_chat_member'):
+            status = bot.get_chat_member(channel_id, user_id).status
     except Exception as e:
         print(f"Ошибка проверки подписки: {e}")
+        # Если Telegram недоступен, лучше ответить недавним результатом, чем закрыть доступ
+        if SUB_CACHE_STALE_MAX_AGE > 0:
+            return membership_cache.get_stale(user_id, SUB_CACHE_STALE_MAX_AGE, False)
         return False
+    subscribed = status in SUBSCRIBED_STATUSES
+    remember_membership(user_id, subscribed)
+    return subscribed
+
+def is_channel_chat(chat):
+    if str(chat.id) == str(channel_id):
+        return True
+    return bool(chat.username) and f'@{chat.username}'.lower() == str(channel_id).lower()
+
+@bot.chat_member_handler()
+@instrumented
+def channel_member_callback(update):
+    if not channel_id or not is_channel_chat(update.chat):
+        return
+    member = update.new_chat_member
+    remember_membership(member.user.id, member.status in SUBSCRIBED_STATUSES)
 
 def get_sub_markup():
-    markup = types.InlineKeyboardMarkup()
-    markup.row(types.InlineKeyboardButton('📢 Подписаться на канал', url=channel_url))
-    markup.row(types.InlineKeyboardButton('🔄 Я подписался', callback_data='check_sub'))
-    return markup
+    return catalog.keyboards['sub']
+
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', '30'))
+SEND_GLOBAL_BURST = float(os.environ.get('SEND_GLOBAL_BURST', '30'))
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = float(os.environ.get('SEND_CHAT_BURST', '3'))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', '3'))
+SEND_RETRY_JITTER = float(os.environ.get('SEND_RETRY_JITTER', '0.5'))
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+class SendScheduler:
+    def __init__(self, rate, burst, chat_rate, chat_burst, max_chats=10000):
+        self.rate = rate
+        self.burst = burst
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_chats = max_chats
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.chats = {}
+        self.waiting_interactive = 0
+        self.cond = threading.Condition()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def chat_bucket(self, chat_id, now):
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= self.max_chats:
+                self.prune_chats(now)
+            bucket = self.chats[chat_id] = [self.chat_burst, now, 0]
+        else:
+            bucket[0] = min(self.chat_burst, bucket[0] + (now - bucket[1]) * self.chat_rate)
+            bucket[1] = now
+        return bucket
+
+    def prune_chats(self, now):
+        # Полные корзины без паузы ничем не отличаются от новых, их можно забыть
+        for chat_id, (tokens, updated, paused_until) in list(self.chats.items()):
+            if paused_until <= now and tokens + (now - updated) * self.chat_rate >= self.chat_burst:
+                del self.chats[chat_id]
+
+    def chat_wait(self, chat_id, now):
+        if chat_id is None:
+            return 0
+        bucket = self.chat_bucket(chat_id, now)
+        if now < bucket[2]:
+            return bucket[2] - now
+        if bucket[0] < 1:
+            return (1 - bucket[0]) / self.chat_rate
+        return 0
+
+    def global_wait(self, priority, now):
+        if now < self.paused_until:
+            return self.paused_until - now
+        if priority == PRIORITY_BACKGROUND and self.waiting_interactive:
+            return 1 / self.rate
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def acquire(self, chat_id=None, priority=PRIORITY_INTERACTIVE):
+        with self.cond:
+            waiting_global = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.refill(now)
+                    # Ответы пользователю идут из общего воркера диспетчера: ожидание лимита одного чата
+                    # задержало бы все чаты этого воркера, поэтому лимит чата соблюдают только фоновые отправки
+                    chat_wait = self.chat_wait(chat_id, now) if priority == PRIORITY_BACKGROUND else 0
+                    global_wait = self.global_wait(priority, now)
+                    if chat_wait <= 0 and global_wait <= 0:
+                        self.tokens -= 1
+                        if chat_id is not None:
+                            self.chat_bucket(chat_id, now)[0] -= 1
+                        return
+                    # Фоновые отправки уступают только интерактивным, которые ждут общий лимит
+                    if priority == PRIORITY_INTERACTIVE and not waiting_global:
+                        waiting_global = True
+                        self.waiting_interactive += 1
+                    self.cond.wait(max(chat_wait, global_wait))
+            finally:
+                if waiting_global:
+                    self.waiting_interactive -= 1
+                    self.cond.notify_all()
+
+    def pause(self, chat_id, seconds):
+        with self.cond:
+            until = time.monotonic() + seconds
+            if chat_id is None:
+                self.paused_until = max(self.paused_until, until)
+            else:
+                bucket = self.chat_bucket(chat_id, time.monotonic())
+                bucket[2] = max(bucket[2], until)
+
+send_scheduler = SendScheduler(SEND_GLOBAL_RATE, SEND_GLOBAL_BURST, SEND_CHAT_RATE, SEND_CHAT_BURST)
+
+def get_retry_after(error):
+    if error.error_code != 429:
+        return None
+    parameters = error.result_json.get('parameters') or {}
+    return parameters.get('retry_after', 1)
+
+def call_api(method, *args, limit_chat=None, priority=PRIORITY_INTERACTIVE, throttle=True, **kwargs):
+    for attempt in range(SEND_MAX_RETRIES + 1):
+        if throttle:
+            send_scheduler.acquire(limit_chat, priority)
+        try:
+            with measure('api', method.__name__):
+                return method(*args, **kwargs)
+        except telebot.apihelper.ApiTelegramException as e:
+            retry_after = get_retry_after(e)
+            if retry_after is None or attempt == SEND_MAX_RETRIES:
+                raise
+            delay = retry_after + random.uniform(0, SEND_RETRY_JITTER)
+            if throttle and limit_chat is not None and priority == PRIORITY_INTERACTIVE:
+                # Не ждём паузу чата в воркере диспетчера: её соблюдут фоновые отправки, а ответ пропадёт
+                send_scheduler.pause(limit_chat, delay)
+                raise
+            print(f"⏳ Flood control в {method.__name__}, повтор через {delay:.1f} сек.")
+            if throttle:
+                send_scheduler.pause(limit_chat, delay)
+            else:
+                time.sleep(delay)
+
+OUTBOUND_CACHE_SIZE = int(os.environ.get('OUTBOUND_CACHE_SIZE', '10000'))
+
+answered_callbacks = TTLCache(OUTBOUND_CACHE_SIZE, 900)
+sent_contents = TTLCache(OUTBOUND_CACHE_SIZE, 48 * 3600)
+pending_edits = {}
+pending_edits_lock = threading.Lock()
+
+def track_pending_edit(key, delta):
+    with pending_edits_lock:
+        count = pending_edits.get(key, 0) + delta
+        if count > 0:
+            pending_edits[key] = count
+        else:
+            pending_edits.pop(key, None)
+
+def has_newer_edit(key):
+    with pending_edits_lock:
+        return pending_edits.get(key, 0) > 1
+
+def answer_callback(call, text=None, show_alert=False):
+    # Telegram учитывает только первый ответ на callback, остальные вызовы — лишние запросы
+    if not answered_callbacks.add(call.id, True):
+        return
+    # Ответы на нажатия не считаются сообщениями и не расходуют лимит отправки
+    call_api(bot.answer_callback_query, call.id, text, show_alert=show_alert, throttle=False)
+
+def send_message(chat_id, text, reply_markup=None, priority=PRIORITY_INTERACTIVE):
+    message = call_api(
+        bot.send_message, chat_id, text, parse_mode='html', reply_markup=reply_markup,
+        limit_chat=chat_id, priority=priority
+    )
+    sent_contents.set((chat_id, message.message_id), (text, reply_markup))
+    return message
+
+def edit_message(text, chat_id, message_id, reply_markup=None, priority=PRIORITY_INTERACTIVE):
+    key = (chat_id, message_id)
+    if has_newer_edit(key):
+        # Пользователь уже нажал следующую кнопку, показываем сразу её результат
+        return None
+    content = (text, reply_markup)
+    if sent_contents.get(key) == content:
+        return None
+    try:
+        result = call_api(
+            bot.edit_message_text, text, chat_id, message_id, parse_mode='html', reply_markup=reply_markup,
+            limit_chat=chat_id, priority=priority
+        )
+    except telebot.apihelper.ApiTelegramException as e:
+        if 'message is not modified' not in e.description:
+            raise
+        result = None
+    sent_contents.set(key, content)
+    return result
+
+ANALYTICS_BUFFER_SIZE = int(os.environ.get('ANALYTICS_BUFFER_SIZE', '50000'))
+ANALYTICS_FLUSH_SIZE = int(os.environ.get('ANALYTICS_FLUSH_SIZE', '1000'))
+ANALYTICS_FLUSH_INTERVAL = float(os.environ.get('ANALYTICS_FLUSH_INTERVAL', '10'))
+
+# При переполнении кольцевой буфер вытесняет самые старые события, обработчики никогда не ждут базу
+analytics_buffer = deque(maxlen=ANALYTICS_BUFFER_SIZE)
+analytics_lock = threading.Lock()
+analytics_flush_lock = threading.Lock()
+analytics_wakeup = threading.Event()
+analytics_counters = {'tracked': 0, 'dropped': 0, 'written': 0, 'flush_errors': 0}
+
+def track_event(event, user_id, topic_id=None, item=None):
+    with analytics_lock:
+        if len(analytics_buffer) == analytics_buffer.maxlen:
+            analytics_counters['dropped'] += 1
+        analytics_buffer.append((now_utc(), event, user_id, topic_id, item))
+        analytics_counters['tracked'] += 1
+        pending = len(analytics_buffer)
+    if pending >= ANALYTICS_FLUSH_SIZE:
+        analytics_wakeup.set()
+
+def take_events(limit):
+    with analytics_lock:
+        return [analytics_buffer.popleft() for _ in range(min(limit, len(analytics_buffer)))]
+
+def return_events(events):
+    with analytics_lock:
+        free = analytics_buffer.maxlen - len(analytics_buffer)
+        analytics_counters['dropped'] += max(0, len(events) - free)
+        # Возвращаем в начало самые свежие из тех, что помещаются
+        keep = events[len(events) - free:] if free < len(events) else events
+        for event in reversed(keep):
+            analytics_buffer.appendleft(event)
+
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', ' ').replace('\n', ' ')
+
+def write_events(cur, events):
+    data = io.StringIO()
+    for row in events:
+        data.write('\t'.join(copy_value(value) for value in row) + '\n')
+    data.seek(0)
+    cur.copy_expert("COPY analytics_events (created_at, event, user_id, topic_id, item) FROM STDIN", data)
+    # Часовые счётчики копим сразу, чтобы отчёты не сканировали сырые события
+    hourly = {}
+    for created_at, event, user_id, topic_id, item in events:
+        key = (created_at.replace(minute=0, second=0, microsecond=0), event, topic_id or '', item or 0)
+        hourly[key] = hourly.get(key, 0) + 1
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO analytics_hourly (hour, event, topic_id, item, count) VALUES %s
+        ON CONFLICT (hour, event, topic_id, item) DO UPDATE SET count = analytics_hourly.count + EXCLUDED.count
+        """,
+        [key + (count,) for key, count in hourly.items()]
+    )
+
+def flush_events():
+    written = 0
+    with analytics_flush_lock:
+        while True:
+            events = take_events(ANALYTICS_FLUSH_SIZE)
+            if not events:
+                return written
+            try:
+                with db_cursor('flush_events', commit=True) as cur:
+                    write_events(cur, events)
+            except Exception as e:
+                return_events(events)
+                with analytics_lock:
+                    analytics_counters['flush_errors'] += 1
+                print(f"❌ Не удалось записать аналитику: {e}")
+                return written
+            written += len(events)
+            with analytics_lock:
+                analytics_counters['written'] += len(events)
+
+def analytics_flusher():
+    while True:
+        analytics_wakeup.wait(ANALYTICS_FLUSH_INTERVAL)
+        analytics_wakeup.clear()
+        flush_events()
+
+def start_analytics():
+    threading.Thread(target=analytics_flusher, name='analytics-flusher', daemon=True).start()
+    atexit.register(flush_events)
 
 @bot.message_handler(commands=['start'])
+@instrumented
 def start(message):
     user_id = message.chat.id
     if not is_subscribed(user_id):
-        bot.send_message(
+        send_message(
             user_id,
             '❌ <b>Доступ закрыт!</b>\n\n⚠️ Для использования бота необходимо подписаться на наш канал.',
-            parse_mode='html',
             reply_markup=get_sub_markup()
         )
         return
-    bot.send_message(
+    remember_bot_user(user_id)
+    track_event('start', user_id)
+    state = get_user_state(user_id)
+    send_message(
         message.chat.id,
-        f'👋 Привет, <b>{message.from_user.first_name}</b>!\n\n{get_status_text(user_id)}',
-        parse_mode='html', reply_markup=get_main_menu_markup(user_id)
+        f'👋 Привет, <b>{message.from_user.first_name}</b>!\n\n{get_status_text(state)}',
+        reply_markup=get_main_menu_markup(state)
     )
 
-topics = {
-    'topic_1': '👶 Эмбриология',
-    'topic_2': '💈 Эпителиальные ткани',
-    'topic_3': '🩸 Кровь и ткани внутренней среды',
-    'topic_4': '🦴 Волокнистая, скелетная и жировая ткани',
-    'topic_5': '👅 Мышечные и нервные ткани',
-    'topic_6': '💉 ССС, органы кроветворения',
-    'topic_7': '👄 Эндокринная система',
-    'topic_8': '👃 Пищеварительная и дыхательная',
-    'topic_9': '🔞 Мочевыделительная и половая',
-}
+def is_admin_message(message):
+    return message.from_user is not None and message.from_user.id in ADMIN_IDS
 
-topic_buttons = {
-    'topic_1': ['Cтроение сперматозоида', 'Строение женской половой клетки', 'Оплодотворение', 'Дробление', 'Имплантация', 'Гаструляция', 'Провизорные органы', 'Нотогенез', 'Плацента: функции, развитие и строение', 'Развитие ЖКТ', 'Развитие дыхательной системы', 'Развитие жаберного аппарата', 'Развитие мочевыделительной системы', 'Развитие половой системы'],
-    'topic_2': ['Основы цитологии', 'Приготовление гистологических препаратов', 'Виды окрасок препаратов', 'Эпителиальная ткань: общая характеристика, классификация и развитие', 'Эпителиальная ткань: однослойные эпителии', 'Многослойные эпителии: неороговевающий и переходный', 'Многослойный плоский ороговевающий эпителий', 'Железистые эпителии: общая характеристика и классификация', 'Железистые эпителии: примеры сложных желез, развитие'],
-    'topic_3': ['Ткани внутренней среды. Свойства, классификация', 'Кровь. Основы гемограммы', 'Эритроциты: строение, функции', 'Эритроциты: строение плазмолеммы', 'Тромбоциты', 'Лейцоциты: нейтрофилы', 'Эозинофилы', 'Базофилы', 'Лимфоциты', 'Моноциты'],
-    'topic_4': ['Собственно соединительная ткань: общая характеристика', 'РВСТ: клеточный состав', 'РВСТ: волокна и аморфное вещество', 'Плотная волокнистая соединительная ткань', 'Ткани со специальными свойствами: жировая ткань', 'Ткани со специальными свойствами: ретикулярная, слизистая и пигментная ткани', 'Хрящевая ткань', 'Скелетные соединительные ткани, обзор', 'Костная ткань. Остеобласты, остеоциты, остеокласты', 'Надкостница и виды костных тканей', 'Пластинчатая костная ткань. Остеоны. Плоские кости', 'Прямой остеогенез. Челюсть зародыша', 'Непрямой остеогенез'],
-    'topic_5': ['Мышечные ткани. Классификация. Основные различия', 'Срез языка. Препарат', 'Строение саркомера', 'Организация миофиламентов', 'Мембранные системы мышечных волокон', 'Сокращение и типы мышечных волокон', 'Мышца как орган. Мион. НМЕ. Переход мышцы в сухожиление. Репарация мышечного волокна', 'Сердечная поперечно-полосатая мышечная ткань', 'Гладкая мышечная ткань', 'Нервная ткань. Функции нейронов и глиоцитов', 'Развитие нервной системы. Три типа нейронов', 'Проводящие пути. Отростки нейронов', 'Цитоплазма нейронов', 'Ультраструктура нейтрона', 'Нейроглия', 'Типы нервных волокон', 'Перехваты Ранвье', 'Нервные окончания', 'Синапсы', 'ЦНС. ПНС. Рефклекторные дуги и прочая магия', 'Нервные стволы, узлы', 'Спинной мозг', 'Мозжечек', 'Кора полушарий', 'Препарат задняя стенка глаза', 'Кортиев орган', 'Вкусовая почка'],
-    'topic_6': ['ССС | Артерии и вены. Общий план', 'ССС | Артерии: классификация, особенности строения', 'ССС | Принципы строения вен и их классификация', 'ССС | Сердце: развитие, строение, функции', 'ССС | Строение микроциркуляторного русла', 'ССС | Лимфатическая система', 'Кроветворение | Этапы кроветворения', 'Кроветворение | Органы кроветворения. Красный костный мозг - строение', 'Кроветворение | Гемопоэтические клетки', 'Кроветворение | Эритроципотоэз и тромбоцитопоэз', 'Кроветворение | Гранулоцитопоэз', 'Кроветворение | Лимфоцитопоэз | АнтигенНЕзависимая дифференцировка', 'Кроветворение | Антигенозависимая дифференцировка', 'Кроветворение | Активированные Т-лимфоциты', 'Кроветворение | Активация В-лимфоцитов, иммуноглобины', 'Кроветворение | Тимус', 'Кроветворение | Лимфатический узел', 'Кроветворение | Селезенка'],
-    'topic_7': ['Общий план строения эндокринной системы', 'Гипотоламо-гипофизарная система', 'Эпифиз', 'Щитовидная железа', 'Околощитовидные железы', 'Надпочечники', 'APUD - серия', 'Общий план строения ЖКТ', 'Ротовая полость: губы, щеки, десны, мягкое и твердое небо', 'Язык', 'Лимфоэпителиальное глоточное кольцо', 'Слюнные железы', 'Общий план строения зуба. Эмаль', 'Строение зуба. Дентин', 'Строение зуба. Цемент и пульпа', 'Одонтогенез. Первый и второй этапы', 'Одонтогенез. Третий этап - гистогенез тканей зуба'],
-    'topic_8': ['Пищевод', 'Желудок', 'Тонкая кишка', 'Толстая кишка', 'Печень', 'Поджелудочная железа', 'Общая характеристика, развитие и функции дыхательной системы', 'Носовая полость, гортань', 'Трахея, бронхиальное дерево', 'Респираторный отдел легкого', 'Кожа', 'Потовые, сальные железы, волосы и ногти', 'Молочные железы'],
-    'topic_9': ['Почка: развитие и общая характеристика строения', 'Почка: нефроны и собирательные трубочки', 'Почка: юкстагломерулярный комплекс', 'Мочевыводящие пути: строение и функции', 'Яичко: развитие, строение и функции', 'Семявыносящие пути: развитие, строение и функции', 'Предстательная железа: развитие, строение и функции', 'Яичник: развитие, строение, функции, циклическая деятельность', 'Маточная труба: развитие, строение и функции', 'Матка: развитие, строение, регенерация, циклические изменения', 'Шейка матки: строение в разных отделах, функции, изменения в разные фазы меструального цикла', 'Влагалище,  развитие, строение, функции и регенерация'],
-}
+def parse_command_args(message):
+    return (message.text or '').split()[1:]
+
+@bot.message_handler(commands=['grant'], func=is_admin_message)
+@instrumented
+def grant_command(message):
+    args = parse_command_args(message)
+    if not args or not args[0].isdecimal() or (len(args) > 1 and not (args[1].isdecimal() and int(args[1]) > 0)):
+        send_message(message.chat.id, 'Использование: <code>/grant user_id [дней]</code>\nБез срока доступ бессрочный.')
+        return
+    user_id = int(args[0])
+    days = int(args[1]) if len(args) > 1 else None
+    expires_at = grant_subscription(user_id, days, message.from_user.id)
+    until = f'до {format_time(expires_at)}' if expires_at else 'бессрочно'
+    send_message(message.chat.id, f'✅ Полный доступ для <code>{user_id}</code> выдан {until}')
+
+@bot.message_handler(commands=['revoke'], func=is_admin_message)
+@instrumented
+def revoke_command(message):
+    args = parse_command_args(message)
+    if len(args) != 1 or not args[0].isdecimal():
+        send_message(message.chat.id, 'Использование: <code>/revoke user_id</code>')
+        return
+    user_id = int(args[0])
+    if revoke_subscription(user_id):
+        send_message(message.chat.id, f'✅ Полный доступ для <code>{user_id}</code> отозван')
+    else:
+        send_message(message.chat.id, f'❌ У <code>{user_id}</code> нет активного доступа')
+
+def get_topic_views(hours):
+    with db_cursor('get_topic_views') as cur:
+        cur.execute(
+            """
+            SELECT event, topic_id, sum(count) FROM analytics_hourly
+            WHERE hour >= date_trunc('hour', now()) - %s
+            GROUP BY event, topic_id
+            """,
+            (timedelta(hours=hours),)
+        )
+        return cur.fetchall()
+
+@bot.message_handler(commands=['stats'], func=is_admin_message)
+@instrumented
+def stats_command(message):
+    args = parse_command_args(message)
+    hours = int(args[0]) if args and args[0].isdecimal() else 24
+    totals = {}
+    views = {}
+    for event, topic_id, count in get_topic_views(hours):
+        totals[event] = totals.get(event, 0) + count
+        if event in ('topic_open', 'content_open'):
+            opened, contents = views.get(topic_id, (0, 0))
+            views[topic_id] = (opened + count, contents) if event == 'topic_open' else (opened, contents + count)
+    current = catalog
+    lines = [f'📊 <b>Статистика за {hours} ч.</b>', '']
+    lines.append(f'👋 /start: <code>{totals.get("start", 0)}</code>')
+    lines.append(f'🎫 Активировали пробный период: <code>{totals.get("trial_activated", 0)}</code>')
+    lines.append(f'🔒 Упёрлись в закрытый раздел: <code>{totals.get("topic_locked", 0)}</code>')
+    lines.append('')
+    for topic_id, topic in current.topics.items():
+        opened, contents = views.get(topic_id, (0, 0))
+        lines.append(f'{topic.title}: <code>{opened}</code> / материалов <code>{contents}</code>')
+    send_message(message.chat.id, '\n'.join(lines))
+
+CallbackAction = namedtuple('CallbackAction', ['kind', 'topic_id', 'item'])
+
+# callback_data: <вид>[:<номер раздела>[:<номер материала>]], например c:1:14
+CALLBACK_ARITY = {'a': 0, 'm': 0, 's': 0, 'i': 0, 't': 1, 'c': 2}
 
-topic_urls = {
-    'topic_1': (f'{top1}', 14),
-    'topic_2': (f'{top2}', 9),
-    'topic_3': (f'{top3}', 10),
-    'topic_4': (f'{top4}', 13),
-    'topic_5': (f'{top5}', 27),
-    'topic_6': (f'{top6}', 18),
-    'topic_7': (f'{top7}', 17),
-    'topic_8': (f'{top8}', 13),
-    'topic_9': (f'{top9}', 12),
+LEGACY_CALLBACKS = {
+    'activate_trial': 'a',
+    'back_to_menu': 'm',
+    'check_sub': 's',
+    'topic_10': 'i',
 }
 
-def get_topic_content(topic_id, content_idx):
-    if topic_id not in topic_urls:
+NAVIGATION_CALLBACKS = {'m', 'i', 't', 'c'}
+
+def make_callback_data(kind, *numbers):
+    return ':'.join([kind, *map(str, numbers)])
+
+def topic_number(topic_id):
+    return int(topic_id.split('_')[1])
+
+def parse_callback_data(data):
+    if not data or len(data) > 64:
+        return None
+    # Кнопки в старых сообщениях продолжают работать
+    if data in LEGACY_CALLBACKS:
+        data = LEGACY_CALLBACKS[data]
+    elif data.startswith('topic_'):
+        data = 't:' + data[6:]
+    elif data.startswith('content_topic_'):
+        data = 'c:' + data[14:].replace('_', ':')
+    parts = data.split(':')
+    if CALLBACK_ARITY.get(parts[0]) != len(parts) - 1:
+        return None
+    if len(parts) == 1:
+        return CallbackAction(parts[0], None, None)
+    if not all(part.isdecimal() for part in parts[1:]):
         return None
-    url, count = topic_urls[topic_id]
-    if content_idx < 1 or content_idx > count:
+    topic_id = f'topic_{int(parts[1])}'
+    if topic_id not in catalog.topics:
         return None
-    return f'{url}'
+    item = int(parts[2]) if len(parts) > 2 else None
+    return CallbackAction(parts[0], topic_id, item)
+
+def get_callback_action(call):
+    # callback_data разбирается один раз при приёме обновления, дальше действие хранится в самом нажатии
+    if not hasattr(call, 'action'):
+        call.action = parse_callback_data(call.data)
+    return call.action
+
+def build_main_menu_markup(topics, with_trial):
+    markup = types.InlineKeyboardMarkup()
+    if with_trial:
+        markup.row(types.InlineKeyboardButton('🎫 Активировать пробный период', callback_data=make_callback_data('a')))
+    buttons = [(topic.title, make_callback_data('t', topic.number)) for topic in topics]
+    buttons.append(('ℹ️ Информация', make_callback_data('i')))
+    markup.row(*[types.InlineKeyboardButton(text, callback_data=data) for text, data in buttons[:2]])
+    for text, data in buttons[2:]:
+        markup.row(types.InlineKeyboardButton(text, callback_data=data))
+    return markup
+
+def build_topic_markup(topic):
+    markup = types.InlineKeyboardMarkup()
+    for i, btn_text in enumerate(topic.items):
+        markup.row(types.InlineKeyboardButton(btn_text, callback_data=make_callback_data('c', topic.number, i + 1)))
+    markup.row(types.InlineKeyboardButton('⬅️ Назад', callback_data=make_callback_data('m')))
+    return markup
+
+def build_content_markup(topic):
+    markup = types.InlineKeyboardMarkup()
+    markup.row(types.InlineKeyboardButton('⬅️ Назад к разделу', callback_data=make_callback_data('t', topic.number)))
+    markup.row(types.InlineKeyboardButton('🏠 Главное меню', callback_data=make_callback_data('m')))
+    return markup
+
+def build_keyboards(topics):
+    # Клавиатуры зависят только от каталога, поэтому сериализуем их один раз
+    back = types.InlineKeyboardMarkup()
+    back.row(types.InlineKeyboardButton('⬅️ Назад', callback_data=make_callback_data('m')))
+    sub = types.InlineKeyboardMarkup()
+    sub.row(types.InlineKeyboardButton('📢 Подписаться на канал', url=channel_url))
+    sub.row(types.InlineKeyboardButton('🔄 Я подписался', callback_data=make_callback_data('s')))
+    result = {
+        'main': build_main_menu_markup(topics, False).to_json(),
+        'main_trial': build_main_menu_markup(topics, True).to_json(),
+        'back': back.to_json(),
+        'sub': sub.to_json(),
+        'topics': {},
+        'content': {},
+    }
+    for topic in topics:
+        if topic.items:
+            result['topics'][topic.topic_id] = build_topic_markup(topic).to_json()
+        result['content'][topic.topic_id] = build_content_markup(topic).to_json()
+    return result
+
+CATALOG_PATH = os.environ.get('CATALOG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.json'))
+CATALOG_RELOAD_INTERVAL = float(os.environ.get('CATALOG_RELOAD_INTERVAL', '10'))
 
-@bot.callback_query_handler(func=lambda call: call.data == 'activate_trial')
-def activate_trial_callback(call):
+Topic = namedtuple('Topic', ['topic_id', 'number', 'title', 'items'])
+Catalog = namedtuple('Catalog', ['version', 'mtime', 'topics', 'contents', 'keyboards'])
+
+def load_catalog(path):
+    mtime = os.stat(path).st_mtime
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    topics = {}
+    contents = {}
+    for entry in data['topics']:
+        number = int(entry['id'])
+        topic_id = f'topic_{number}'
+        if topic_id in topics:
+            raise ValueError(f'Раздел {number} описан дважды')
+        # Общая ссылка раздела, если у материала нет своей
+        default_content = entry.get('url') or os.environ.get(entry.get('url_env', ''))
+        for idx, item in enumerate(entry['items'], 1):
+            content = item.get('content') or default_content
+            if content:
+                contents[(topic_id, idx)] = content
+        items = tuple(item['title'] for item in entry['items'])
+        topics[topic_id] = Topic(topic_id, number, entry['title'], items)
+    return Catalog(
+        data.get('version', 0), mtime, MappingProxyType(topics), MappingProxyType(contents),
+        build_keyboards(list(topics.values()))
+    )
+
+catalog = load_catalog(CATALOG_PATH)
+catalog_lock = threading.Lock()
+catalog_failed_mtime = None
+catalog_reload_requested = threading.Event()
+
+def reload_catalog(force=False):
+    global catalog, catalog_failed_mtime
+    with catalog_lock:
+        mtime = None
+        try:
+            mtime = os.stat(CATALOG_PATH).st_mtime
+            if not force and mtime in (catalog.mtime, catalog_failed_mtime):
+                return False
+            new_catalog = load_catalog(CATALOG_PATH)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            catalog_failed_mtime = mtime
+            print(f"❌ Каталог не обновлён, остаётся версия {catalog.version}: {e}")
+            return False
+        # Обработчики берут каталог одной ссылкой, поэтому замена атомарна
+        catalog = new_catalog
+        catalog_failed_mtime = None
+    print(f"✅ Каталог обновлён до версии {catalog.version}")
+    return True
+
+def catalog_watcher():
+    while True:
+        requested = catalog_reload_requested.wait(CATALOG_RELOAD_INTERVAL or None)
+        catalog_reload_requested.clear()
+        reload_catalog(force=requested)
+
+def start_catalog_watcher():
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: catalog_reload_requested.set())
+    threading.Thread(target=catalog_watcher, name='catalog-watcher', daemon=True).start()
+
+@instrumented
+def activate_trial_callback(call, action):
     user_id = call.message.chat.id
-    if user_id in users:
-        bot.answer_callback_query(call.id, '⚡ У вас уже есть полный доступ!')
+    state = get_user_state(user_id)
+    if state.access == 'full':
+        answer_callback(call, '⚡ У вас уже есть полный доступ!')
         return
-    if has_used_trial(user_id):
-        bot.answer_callback_query(call.id, '❌ Вы уже использовали пробный период!')
+    if state.trial_used:
+        answer_callback(call, '❌ Вы уже использовали пробный период!')
         return
     if start_trial(user_id):
-        bot.answer_callback_query(call.id, '🎁 Пробный период активирован!')
-        bot.edit_message_text(
-            f'🎁 Пробный период активирован!\n\n{get_status_text(user_id)}',
+        track_event('trial_activated', user_id)
+        state = get_user_state(user_id)
+        answer_callback(call, '🎁 Пробный период активирован!')
+        edit_message(
+            f'🎁 Пробный период активирован!\n\n{get_status_text(state)}',
             call.message.chat.id, call.message.message_id,
-            parse_mode='html', reply_markup=get_main_menu_markup(user_id)
+            reply_markup=get_main_menu_markup(state)
         )
     else:
-        bot.answer_callback_query(call.id, '❌ Не удалось активировать')
+        answer_callback(call, '❌ Не удалось активировать')
 
-@bot.callback_query_handler(func=lambda call: call.data == 'back_to_menu')
-def back_to_menu_callback(call):
+@instrumented
+def back_to_menu_callback(call, action):
     user_id = call.message.chat.id
-    bot.answer_callback_query(call.id)
-    bot.edit_message_text(
-        get_status_text(user_id),
+    state = get_user_state(user_id)
+    answer_callback(call)
+    edit_message(
+        get_status_text(state),
         call.message.chat.id, call.message.message_id,
-        parse_mode='html', reply_markup=get_main_menu_markup(user_id)
+        reply_markup=get_main_menu_markup(state)
     )
 
-@bot.callback_query_handler(func=lambda call: call.data == 'check_sub')
-def check_sub_callback(call):
+@instrumented
+def check_sub_callback(call, action):
     user_id = call.message.chat.id
-    if is_subscribed(user_id):
-        bot.answer_callback_query(call.id, '✅ Подписка подтверждена!')
-        bot.edit_message_text(
-            f'👋 Привет, <b>{call.from_user.first_name}</b>!\n\n{get_status_text(user_id)}',
+    if is_subscribed(user_id, refresh=True):
+        state = get_user_state(user_id)
+        answer_callback(call, '✅ Подписка подтверждена!')
+        edit_message(
+            f'👋 Привет, <b>{call.from_user.first_name}</b>!\n\n{get_status_text(state)}',
             user_id, call.message.message_id,
-            parse_mode='html', reply_markup=get_main_menu_markup(user_id)
+            reply_markup=get_main_menu_markup(state)
         )
     else:
-        bot.answer_callback_query(call.id, '❌ Вы еще не подписались!', show_alert=True)
+        answer_callback(call, '❌ Вы еще не подписались!', show_alert=True)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('topic_'))
-def topic_callback(call):
-    topic_id = call.data
+def ensure_subscribed(call):
     user_id = call.message.chat.id
-    bot.answer_callback_query(call.id)
+    if is_subscribed(user_id):
+        return True
+    track_event('subscription_required', user_id)
+    answer_callback(call, '❌ Вы отписались от канала!', show_alert=True)
+    edit_message(
+        '⚠️ <b>Доступ закрыт!</b>\n\nДля использования бота необходимо быть подписанным на наш канал.',
+        user_id, call.message.message_id,
+        reply_markup=get_sub_markup()
+    )
+    return False
 
-    if not is_subscribed(user_id):
-        bot.answer_callback_query(call.id, '❌ Вы отписались от канала!', show_alert=True)
-        bot.edit_message_text(
-            '⚠️ <b>Доступ закрыт!</b>\n\nДля использования бота необходимо быть подписанным на наш канал.',
-            user_id, call.message.message_id,
-            parse_mode='html',
-            reply_markup=get_sub_markup()
-        )
+@instrumented
+def info_callback(call, action):
+    if not ensure_subscribed(call):
         return
-    
-    bot.answer_callback_query(call.id)
-    
-    if topic_id == 'topic_10':
-        markup = types.InlineKeyboardMarkup()
-        markup.row(types.InlineKeyboardButton('⬅️ Назад', callback_data='back_to_menu'))
-        bot.edit_message_text( f'ℹ️ <b>Информация</b>\n\n🔬 9 разделов для изучения\n\n⭐ Поддержка: {manager}',
-            call.message.chat.id, call.message.message_id, parse_mode='html', reply_markup=markup
-        )
+    current = catalog
+    answer_callback(call)
+    edit_message( f'ℹ️ <b>Информация</b>\n\n🔬 {len(current.topics)} разделов для изучения\n\n⭐ Поддержка: {manager}',
+        call.message.chat.id, call.message.message_id, reply_markup=current.keyboards['back']
+    )
+
+@instrumented
+def topic_callback(call, action):
+    topic_id = action.topic_id
+    user_id = call.message.chat.id
+
+    if not ensure_subscribed(call):
         return
     
-    access = has_access(user_id, topic_id)
-    if access is None or (access == 'trial' and topic_id != 'topic_1'):
-        topic_name = topics.get(topic_id, 'Раздел')
-        markup = types.InlineKeyboardMarkup()
-        markup.row(types.InlineKeyboardButton('⬅️ Назад', callback_data='back_to_menu'))
-        if has_used_trial(user_id):
+    current = catalog
+    topic = current.topics.get(topic_id)
+    if topic is None:
+        # Раздел убрали из каталога, пока нажатие ждало в очереди
+        answer_callback(call, '⚠️ Кнопка устарела, отправьте /start')
+        return
+    topic_name = topic.title
+    state = get_user_state(user_id)
+    access = has_access(state, topic_id)
+    if access is None:
+        if state.access == 'expired':
             text = f'<b>{topic_name}</b>\n\n🔒 Этот раздел недоступен.\n\n⌛ Ваша пробная подписка истекла.\n\n⭐ Для полного доступа обратитесь к {manager}'
-        elif access == 'trial':
+        elif state.access == 'trial':
             text = f'<b>{topic_name}</b>\n\n🔒 Этот раздел недоступен.\n\n📚 В пробной версии доступна только 👶 Эмбриология.\n\n⭐ Для полного доступа обратитесь к {manager}'
         else:
             text = f'<b>{topic_name}</b>\n\n🔒 Этот раздел недоступен.\n\n🎫 Активируйте пробный период для доступа к разделу 👶 Эмбриология.\n\n⭐ Для полного доступа обратитесь к {manager}'
-        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode='html', reply_markup=markup)
+        track_event('topic_locked', user_id, topic_id)
+        answer_callback(call)
+        edit_message(text, call.message.chat.id, call.message.message_id, reply_markup=current.keyboards['back'])
         return
-    if topic_id not in topic_buttons or not topic_buttons[topic_id]:
-        bot.answer_callback_query(call.id, '❌ Раздел пуст или в разработке')
+    markup = current.keyboards['topics'].get(topic_id)
+    if markup is None:
+        answer_callback(call, '❌ Раздел пуст или в разработке')
         return
     
-    markup = types.InlineKeyboardMarkup()
-    for i, btn_text in enumerate(topic_buttons[topic_id]):
-        markup.row(types.InlineKeyboardButton(btn_text, callback_data=f'content_{topic_id}_{i+1}'))
-    markup.row(types.InlineKeyboardButton('⬅️ Назад', callback_data='back_to_menu'))
-    
-    bot.edit_message_text(
-        f'<b>{topics.get(topic_id, "Раздел")}</b>',
+    track_event('topic_open', user_id, topic_id)
+    answer_callback(call)
+    edit_message(
+        f'<b>{topic_name}</b>',
         call.message.chat.id, call.message.message_id,
-        parse_mode='html', reply_markup=markup
+        reply_markup=markup
     )
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith('content_'))
-def content_callback(call):
-    bot.answer_callback_query(call.id)
-    parts = call.data.split('_')
-    if len(parts) < 4:
-        return
-    
-    topic_id = f'{parts[1]}_{parts[2]}'
-    content_idx = int(parts[3])
+@instrumented
+def content_callback(call, action):
+    topic_id = action.topic_id
+    content_idx = action.item
     user_id = call.message.chat.id
     
-    if has_access(user_id, topic_id) is None:
+    if has_access(get_user_state(user_id), topic_id) is None:
+        answer_callback(call)
         return
     
-    content = get_topic_content(topic_id, content_idx)
+    current = catalog
+    content = current.contents.get((topic_id, content_idx))
     if content is None:
-        bot.answer_callback_query(call.id, '❌ Не найдено')
+        answer_callback(call, '❌ Не найдено')
         return
     
-    markup = types.InlineKeyboardMarkup()
-    markup.row(types.InlineKeyboardButton('⬅️ Назад к разделу', callback_data=topic_id))
-    markup.row(types.InlineKeyboardButton('🏠 Главное меню', callback_data='back_to_menu'))
-    
-    bot.edit_message_text(content, call.message.chat.id, call.message.message_id, parse_mode='html', reply_markup=markup)
+    track_event('content_open', user_id, topic_id, content_idx)
+    answer_callback(call)
+    edit_message(content, call.message.chat.id, call.message.message_id, reply_markup=current.keyboards['content'][topic_id])
+
+CALLBACK_ROUTES = {
+    'a': activate_trial_callback,
+    'm': back_to_menu_callback,
+    's': check_sub_callback,
+    'i': info_callback,
+    't': topic_callback,
+    'c': content_callback,
+}
+
+@bot.callback_query_handler(func=lambda call: True)
+def route_callback(call):
+    action = get_callback_action(call)
+    if action is None or call.message is None:
+        answer_callback(call, '⚠️ Кнопка устарела, отправьте /start')
+        return
+    CALLBACK_ROUTES[action.kind](call, action)
+
+BULK_SEND_CONCURRENCY = int(os.environ.get('BULK_SEND_CONCURRENCY', '8'))
+TRIAL_SWEEP_INTERVAL = float(os.environ.get('TRIAL_SWEEP_INTERVAL', '300'))
+TRIAL_SWEEP_BATCH = int(os.environ.get('TRIAL_SWEEP_BATCH', '500'))
+TRIAL_REMINDER_HOURS = float(os.environ.get('TRIAL_REMINDER_HOURS', '3'))
+TRIAL_EXPIRED_LOOKBACK_HOURS = float(os.environ.get('TRIAL_EXPIRED_LOOKBACK_HOURS', '24'))
+
+known_bot_users = TTLCache(USER_STATE_CACHE_SIZE, 3600)
+
+def remember_bot_user(user_id):
+    if not known_bot_users.add(user_id, True):
+        return
+    with db_cursor('remember_bot_user', commit=True) as cur:
+        cur.execute(
+            """
+            INSERT INTO bot_users (user_id) VALUES (%s)
+            ON CONFLICT (user_id) DO UPDATE SET blocked_at = NULL WHERE bot_users.blocked_at IS NOT NULL
+            """,
+            (user_id,)
+        )
+
+def mark_users_blocked(user_ids):
+    if not user_ids:
+        return
+    with db_cursor('mark_users_blocked', commit=True) as cur:
+        cur.execute(
+            "UPDATE bot_users SET blocked_at = now() WHERE user_id = ANY(%s) AND blocked_at IS NULL",
+            (list(user_ids),)
+        )
+    for user_id in user_ids:
+        known_bot_users.pop(user_id)
+
+def is_blocked_error(error):
+    if error.error_code == 403:
+        return True
+    return error.error_code == 400 and 'chat not found' in error.description
+
+def deliver_message(chat_id, text):
+    try:
+        # Напрямую, без send_message: массовая отправка не должна вытеснять кэш содержимого сообщений
+        call_api(bot.send_message, chat_id, text, parse_mode='html', limit_chat=chat_id, priority=PRIORITY_BACKGROUND)
+        return 'sent'
+    except telebot.apihelper.ApiTelegramException as e:
+        if is_blocked_error(e):
+            return 'blocked'
+        print(f"❌ Не удалось отправить сообщение {chat_id}: {e}")
+        return 'failed'
+    except Exception as e:
+        print(f"❌ Не удалось отправить сообщение {chat_id}: {e}")
+        return 'failed'
+
+def send_bulk(messages):
+    # Темп задаёт планировщик отправки, фоновые сообщения пропускают вперёд ответы пользователям
+    with ThreadPoolExecutor(max_workers=BULK_SEND_CONCURRENCY) as executor:
+        statuses = list(executor.map(lambda message: deliver_message(*message), messages))
+    mark_users_blocked([chat_id for (chat_id, text), status in zip(messages, statuses) if status == 'blocked'])
+    return statuses
+
+def claim_trials(column, lower, upper):
+    # Строки помечаются до отправки: даже несколько копий бота не напишут одному пользователю дважды
+    query = sql.SQL("""
+        UPDATE trial_users SET {column} = now()
+        WHERE user_id IN (
+            SELECT user_id FROM trial_users
+            WHERE trial_expiry > %s AND trial_expiry <= %s AND {column} IS NULL
+            ORDER BY trial_expiry
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING user_id, trial_expiry
+    """).format(column=sql.Identifier(column))
+    with db_cursor('claim_trials', commit=True) as cur:
+        cur.execute(query, (lower, upper, TRIAL_SWEEP_BATCH))
+        return cur.fetchall()
+
+def trial_reminder_text(trial_expiry):
+    remaining = max(trial_expiry - now_utc(), timedelta(0))
+    hours = int(remaining.total_seconds() // 3600)
+    minutes = int((remaining.total_seconds() % 3600) // 60)
+    return f'⏳ <b>Пробный период скоро закончится</b>\n\n🕧 Осталось: <code>{hours} ч. {minutes} мин.</code>\n\n⭐ Для полного доступа обратитесь к {manager}'
+
+def trial_expired_text(trial_expiry):
+    return f'⌛ <b>Пробный период закончился</b>\n\n⭐ Для полного доступа обратитесь к {manager}'
+
+def notify_trials(column, lower, upper, build_text):
+    total = 0
+    while True:
+        rows = claim_trials(column, lower, upper)
+        for user_id, trial_expiry in rows:
+            invalidate_user_state(user_id)
+        messages = [(user_id, build_text(trial_expiry)) for user_id, trial_expiry in rows if not has_full_access(user_id)]
+        total += send_bulk(messages).count('sent')
+        if len(rows) < TRIAL_SWEEP_BATCH:
+            return total
+
+def sweep_trials():
+    with db_cursor('mark_missed_trials', commit=True) as cur:
+        mark_missed_trials(cur)
+    now = now_utc()
+    reminded = notify_trials('reminder_sent_at', now, now + timedelta(hours=TRIAL_REMINDER_HOURS), trial_reminder_text)
+    expired = notify_trials('expired_notified_at', now - timedelta(hours=TRIAL_EXPIRED_LOOKBACK_HOURS), now, trial_expired_text)
+    if reminded or expired:
+        print(f"✅ Пробный период: напоминаний {reminded}, уведомлений об окончании {expired}")
+
+def trial_sweeper():
+    while True:
+        try:
+            sweep_trials()
+        except Exception as e:
+            print(f"❌ Ошибка проверки пробных периодов: {e}")
+        time.sleep(TRIAL_SWEEP_INTERVAL)
+
+def start_trial_sweeper():
+    if TRIAL_SWEEP_INTERVAL > 0:
+        threading.Thread(target=trial_sweeper, name='trial-sweeper', daemon=True).start()
+
+BROADCAST_BATCH = int(os.environ.get('BROADCAST_BATCH', '500'))
+BROADCAST_PROGRESS_INTERVAL = float(os.environ.get('BROADCAST_PROGRESS_INTERVAL', '15'))
+
+running_broadcasts = set()
+running_broadcasts_lock = threading.Lock()
+
+def create_broadcast(text, created_by, admin_chat_id):
+    with db_cursor('create_broadcast', commit=True) as cur:
+        cur.execute(
+            "INSERT INTO broadcasts (text, created_by, admin_chat_id) VALUES (%s, %s, %s) RETURNING id",
+            (text, created_by, admin_chat_id)
+        )
+        return cur.fetchone()[0]
+
+def get_broadcast(broadcast_id):
+    with db_cursor('get_broadcast') as cur:
+        cur.execute("SELECT text, admin_chat_id, status FROM broadcasts WHERE id = %s", (broadcast_id,))
+        return cur.fetchone()
+
+def iter_broadcast_batches(broadcast_id):
+    # Каждая порция — отдельный короткий запрос: рассылка идёт часами и не должна держать транзакцию и соединение из пула
+    last_user_id = -2 ** 63
+    while True:
+        with db_cursor('iter_broadcast_batches') as cur:
+            cur.execute(
+                """
+                SELECT u.user_id FROM bot_users u
+                WHERE u.user_id > %s AND u.blocked_at IS NULL AND NOT EXISTS (
+                    SELECT 1 FROM broadcast_deliveries d
+                    WHERE d.broadcast_id = %s AND d.user_id = u.user_id AND d.status IN ('sent', 'blocked')
+                )
+                ORDER BY u.user_id
+                LIMIT %s
+                """,
+                (last_user_id, broadcast_id, BROADCAST_BATCH)
+            )
+            user_ids = [user_id for (user_id,) in cur.fetchall()]
+        if not user_ids:
+            return
+        last_user_id = user_ids[-1]
+        yield user_ids
+
+def record_deliveries(broadcast_id, user_ids, statuses):
+    with db_cursor('record_deliveries', commit=True) as cur:
+        psycopg2.extras.execute_values(
+            cur,
+            """
+            INSERT INTO broadcast_deliveries (broadcast_id, user_id, status) VALUES %s
+            ON CONFLICT (broadcast_id, user_id) DO UPDATE SET status = EXCLUDED.status, sent_at = CURRENT_TIMESTAMP
+            """,
+            [(broadcast_id, user_id, status) for user_id, status in zip(user_ids, statuses)]
+        )
+
+def get_delivery_counts(broadcast_id):
+    with db_cursor('get_delivery_counts') as cur:
+        cur.execute(
+            "SELECT status, count(*) FROM broadcast_deliveries WHERE broadcast_id = %s GROUP BY status",
+            (broadcast_id,)
+        )
+        return dict(cur.fetchall())
+
+def finish_broadcast(broadcast_id):
+    with db_cursor('finish_broadcast', commit=True) as cur:
+        cur.execute("UPDATE broadcasts SET status = 'finished', finished_at = now() WHERE id = %s", (broadcast_id,))
+
+def broadcast_progress_text(broadcast_id, counts, sent_now, elapsed, finished=False, paused=False):
+    rate = sent_now / elapsed if elapsed else 0
+    if paused:
+        title = f'⏸ <b>Рассылка #{broadcast_id} приостановлена</b>\n\nНе доставленные сообщения отправятся после перезапуска или по /broadcast_resume {broadcast_id}'
+    elif finished:
+        title = f'✅ <b>Рассылка #{broadcast_id} завершена</b>'
+    else:
+        title = f'📣 <b>Рассылка #{broadcast_id} идёт</b>'
+    return (
+        f'{title}\n\n'
+        f'📨 Доставлено: <code>{counts.get("sent", 0)}</code>\n'
+        f'🚫 Заблокировали бота: <code>{counts.get("blocked", 0)}</code>\n'
+        f'❌ Ошибок: <code>{counts.get("failed", 0)}</code>\n'
+        f'⚡ Скорость: <code>{rate:.1f} сообщ./сек</code>'
+    )
+
+def run_broadcast(broadcast_id):
+    with running_broadcasts_lock:
+        if broadcast_id in running_broadcasts:
+            return
+        running_broadcasts.add(broadcast_id)
+    try:
+        text, admin_chat_id, status = get_broadcast(broadcast_id)
+        # Учитываем доставки прошлых запусков, чтобы после возобновления счётчики не начинались с нуля
+        counts = get_delivery_counts(broadcast_id)
+        progress = send_message(admin_chat_id, broadcast_progress_text(broadcast_id, counts, 0, 0)) if admin_chat_id else None
+        started = time.monotonic()
+        reported = started
+        sent_now = 0
+        failed_now = 0
+        # Ошибки прошлых запусков отправляются заново, поэтому считаем их с нуля
+        counts.pop('failed', None)
+        for user_ids in iter_broadcast_batches(broadcast_id):
+            statuses = send_bulk([(user_id, text) for user_id in user_ids])
+            record_deliveries(broadcast_id, user_ids, statuses)
+            for status in statuses:
+                counts[status] = counts.get(status, 0) + 1
+            sent_now += len(statuses)
+            failed_now += statuses.count('failed')
+            if statuses.count('failed') == len(statuses):
+                # Не доставилось ни одно сообщение порции — похоже на сбой Telegram или сети, дальше не идём
+                break
+            if progress and time.monotonic() - reported >= BROADCAST_PROGRESS_INTERVAL:
+                reported = time.monotonic()
+                edit_message(broadcast_progress_text(broadcast_id, counts, sent_now, reported - started),
+                             admin_chat_id, progress.message_id, priority=PRIORITY_BACKGROUND)
+        # С ошибками рассылка остаётся незавершённой, чтобы недоставленные получили сообщение при возобновлении
+        if failed_now:
+            if progress:
+                edit_message(broadcast_progress_text(broadcast_id, counts, sent_now, time.monotonic() - started, paused=True),
+                             admin_chat_id, progress.message_id)
+            print(f"⏸ Рассылка #{broadcast_id} приостановлена: {counts}")
+            return
+        finish_broadcast(broadcast_id)
+        if progress:
+            edit_message(broadcast_progress_text(broadcast_id, counts, sent_now, time.monotonic() - started, finished=True),
+                         admin_chat_id, progress.message_id)
+        print(f"✅ Рассылка #{broadcast_id} завершена: {counts}")
+    except Exception as e:
+        print(f"❌ Рассылка #{broadcast_id} прервана: {e}")
+    finally:
+        with running_broadcasts_lock:
+            running_broadcasts.discard(broadcast_id)
+
+def start_broadcast(broadcast_id):
+    threading.Thread(target=run_broadcast, args=(broadcast_id,), name=f'broadcast-{broadcast_id}', daemon=True).start()
+
+def resume_broadcasts():
+    with db_cursor('resume_broadcasts') as cur:
+        cur.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+        broadcast_ids = [broadcast_id for (broadcast_id,) in cur.fetchall()]
+    for broadcast_id in broadcast_ids:
+        print(f"♻️ Возобновляем рассылку #{broadcast_id}")
+        start_broadcast(broadcast_id)
+
+@bot.message_handler(commands=['broadcast'], func=is_admin_message)
+@instrumented
+def broadcast_command(message):
+    if message.reply_to_message and (message.reply_to_message.text or message.reply_to_message.caption):
+        text = message.reply_to_message.html_text or message.reply_to_message.html_caption
+    else:
+        parts = (message.html_text or '').split(maxsplit=1)
+        text = parts[1] if len(parts) > 1 else None
+    if not text:
+        send_message(message.chat.id, 'Использование: <code>/broadcast текст</code> или ответом на сообщение')
+        return
+    broadcast_id = create_broadcast(text, message.from_user.id, message.chat.id)
+    start_broadcast(broadcast_id)
+
+@bot.message_handler(commands=['broadcast_resume'], func=is_admin_message)
+@instrumented
+def broadcast_resume_command(message):
+    args = parse_command_args(message)
+    if len(args) != 1 or not args[0].isdecimal():
+        send_message(message.chat.id, 'Использование: <code>/broadcast_resume id</code>')
+        return
+    broadcast = get_broadcast(int(args[0]))
+    if broadcast is None or broadcast[2] != 'running':
+        send_message(message.chat.id, f'❌ Незавершённой рассылки #{args[0]} нет')
+        return
+    start_broadcast(int(args[0]))
+
+DISPATCH_WORKERS = int(os.environ.get('DISPATCH_WORKERS', '4'))
+DISPATCH_QUEUE_SIZE = int(os.environ.get('DISPATCH_QUEUE_SIZE', '1000'))
+DISPATCH_ENQUEUE_TIMEOUT = float(os.environ.get('DISPATCH_ENQUEUE_TIMEOUT', '1'))
+DISPATCH_DEDUP_SIZE = int(os.environ.get('DISPATCH_DEDUP_SIZE', '10000'))
+POLLING_TIMEOUT = int(os.environ.get('POLLING_TIMEOUT', '20'))
+
+dispatch_queues = [queue.Queue(max(1, DISPATCH_QUEUE_SIZE // DISPATCH_WORKERS)) for _ in range(DISPATCH_WORKERS)]
+dispatch_lock = threading.Lock()
+dispatch_started = False
+recent_update_ids = OrderedDict()
+dispatch_counters = {'accepted': 0, 'duplicates': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+
+def count_dispatch(name):
+    with dispatch_lock:
+        dispatch_counters[name] += 1
+
+def get_update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    if update.chat_member:
+        return update.chat_member.new_chat_member.user.id
+    return 0
+
+def get_update_type(update):
+    for update_type in ALLOWED_UPDATES:
+        if getattr(update, update_type, None) is not None:
+            return update_type
+    return 'other'
+
+def remember_update_id(update_id):
+    with dispatch_lock:
+        if update_id in recent_update_ids:
+            dispatch_counters['duplicates'] += 1
+            return False
+        recent_update_ids[update_id] = True
+        if len(recent_update_ids) > DISPATCH_DEDUP_SIZE:
+            recent_update_ids.popitem(last=False)
+        return True
+
+def forget_update_id(update_id):
+    with dispatch_lock:
+        recent_update_ids.pop(update_id, None)
+
+def get_edit_key(update):
+    call = update.callback_query
+    if call is None or call.message is None:
+        return None
+    action = get_callback_action(call)
+    if action is None or action.kind not in NAVIGATION_CALLBACKS:
+        return None
+    return (call.message.chat.id, call.message.message_id)
+
+def submit_update(update, timeout=None):
+    if not remember_update_id(update.update_id):
+        return True
+    # Обновления одного чата всегда попадают в одну очередь и обрабатываются по порядку
+    q = dispatch_queues[get_update_chat_id(update) % len(dispatch_queues)]
+    edit_key = get_edit_key(update)
+    if edit_key:
+        track_pending_edit(edit_key, 1)
+    try:
+        # Ключ считаем один раз: к концу обработки каталог мог перечитаться и кнопка перестала бы разбираться
+        q.put((update, edit_key), timeout=timeout)
+    except queue.Full:
+        if edit_key:
+            track_pending_edit(edit_key, -1)
+        forget_update_id(update.update_id)
+        count_dispatch('rejected')
+        return False
+    count_dispatch('accepted')
+    return True
+
+def dispatch_worker(q):
+    while True:
+        update, edit_key = q.get()
+        start_trace(update.update_id, get_update_type(update))
+        try:
+            bot.process_new_updates([update])
+            count_dispatch('processed')
+        except Exception as e:
+            count_dispatch('failed')
+            print(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+        finally:
+            if edit_key:
+                track_pending_edit(edit_key, -1)
+            # Наблюдатели трассировки видят обновление уже полностью обработанным
+            finish_trace()
+            q.task_done()
+
+def start_dispatcher():
+    global dispatch_started
+    with dispatch_lock:
+        if dispatch_started:
+            return
+        dispatch_started = True
+    for i, q in enumerate(dispatch_queues):
+        threading.Thread(target=dispatch_worker, args=(q,), name=f'dispatch-{i}', daemon=True).start()
+
+def get_dispatch_stats():
+    depths = [q.qsize() for q in dispatch_queues]
+    with dispatch_lock:
+        stats = dict(dispatch_counters)
+    stats['queue_depth'] = sum(depths)
+    stats['max_worker_queue_depth'] = max(depths)
+    stats['queue_capacity'] = sum(q.maxsize for q in dispatch_queues)
+    stats['workers'] = len(dispatch_queues)
+    return stats
+
+metrics.define('bot_dispatch_updates_total', 'counter', 'Обновления по результату приёма и обработки')
+metrics.define('bot_dispatch_queue_depth', 'gauge', 'Обновлений в очередях диспетчера')
+metrics.define('bot_dispatch_queue_capacity', 'gauge', 'Суммарная ёмкость очередей диспетчера')
+metrics.define('bot_analytics_events_total', 'counter', 'События аналитики по судьбе')
+metrics.define('bot_analytics_buffered_events', 'gauge', 'События аналитики, ожидающие записи')
+metrics.define('bot_subscribers', 'gauge', 'Пользователи с полным доступом в реестре')
+
+def render_metrics():
+    stats = get_dispatch_stats()
+    for name in dispatch_counters:
+        metrics.set('bot_dispatch_updates_total', (('result', name),), stats[name])
+    metrics.set('bot_dispatch_queue_depth', (), stats['queue_depth'])
+    metrics.set('bot_dispatch_queue_capacity', (), stats['queue_capacity'])
+    with analytics_lock:
+        for name, value in analytics_counters.items():
+            metrics.set('bot_analytics_events_total', (('result', name),), value)
+        metrics.set('bot_analytics_buffered_events', (), len(analytics_buffer))
+    metrics.set('bot_subscribers', (), len(subscribers))
+    return metrics.render()
+
+def get_slow_traces():
+    return list(slow_traces)
+
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9100'))
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = render_metrics().encode('utf-8')
+            content_type = PROMETHEUS_CONTENT_TYPE
+        elif self.path == '/traces':
+            body = json.dumps(get_slow_traces(), ensure_ascii=False).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server():
+    # В режиме webhook метрики отдаёт Flask, отдельный сервер нужен только для polling
+    if METRICS_PORT <= 0:
+        return
+    try:
+        server = ThreadingHTTPServer(('0.0.0.0', METRICS_PORT), MetricsRequestHandler)
+    except OSError as e:
+        print(f"❌ Не удалось запустить сервер метрик на порту {METRICS_PORT}: {e}")
+        return
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    print(f"📊 Метрики доступны на порту {METRICS_PORT}: /metrics, /traces")
+
+def run_polling():
+    bot.remove_webhook()
+    offset = None
+    while True:
+        try:
+            with measure('api', 'get_updates'):
+                updates = bot.get_updates(
+                    offset=offset, allowed_updates=ALLOWED_UPDATES, long_polling_timeout=POLLING_TIMEOUT
+                )
+        except Exception as e:
+            print(f"❌ Polling error: {e}")
+            time.sleep(3)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            # В режиме polling переполненная очередь просто притормаживает получение новых обновлений
+            submit_update(update)
 
 WEBHOOK_HOST = os.environ.get('WEBHOOK_HOST')
 WEBHOOK_PORT = int(os.environ.get('PORT', '10000'))
@@ -362,28 +1934,55 @@ if WEBHOOK_HOST:
     def webhook():
         if flask.request.headers.get('content-type') == 'application/json':
             update = telebot.types.Update.de_json(flask.request.get_data().decode('utf-8'))
-            bot.process_new_updates([update])
+            if not submit_update(update, timeout=DISPATCH_ENQUEUE_TIMEOUT):
+                # Telegram повторит доставку позже
+                return 'Busy', 503
             return ''
         flask.abort(403)
 
+    @app.route('/stats')
+    def stats():
+        return flask.jsonify(get_dispatch_stats())
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return flask.Response(render_metrics(), content_type=PROMETHEUS_CONTENT_TYPE)
+
+    @app.route('/traces')
+    def traces_endpoint():
+        return flask.jsonify(get_slow_traces())
+
 if __name__ == '__main__':
     try:
         init_db()
         print("✅ Database initialized.")
+        print(f"✅ Loaded {refresh_subscriptions()} subscriptions.")
     except Exception as e:
         print(f"❌ Error connecting to database: {e}")
-        
-if WEBHOOK_HOST:
-    clean_host = WEBHOOK_HOST.replace("https://", "").replace("http://", "")
-    full_url = f"https://{clean_host}{WEBHOOK_URL_PATH}"
-    print(f"DEBUG: Setting webhook to: {full_url}")
+
+    # По SIGTERM (перезапуск на хостинге) выходим штатно, чтобы atexit успел дописать аналитику
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_analytics()
+    start_subscriptions_sync()
+    start_trial_sweeper()
     try:
-        bot.remove_webhook()
-        bot.set_webhook(url=full_url)
-        print("✅ Webhook successfully set!")
+        resume_broadcasts()
     except Exception as e:
-        print(f"❌ Webhook error (but continuing...): {e}")
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
-else:
+        print(f"❌ Не удалось возобновить рассылки: {e}")
+    start_catalog_watcher()
+    start_dispatcher()
+    if WEBHOOK_HOST:
+        clean_host = WEBHOOK_HOST.replace("https://", "").replace("http://", "")
+        full_url = f"https://{clean_host}{WEBHOOK_URL_PATH}"
+        print(f"DEBUG: Setting webhook to: {full_url}")
+        try:
+            bot.remove_webhook()
+            bot.set_webhook(url=full_url, allowed_updates=ALLOWED_UPDATES)
+            print("✅ Webhook successfully set!")
+        except Exception as e:
+            print(f"❌ Webhook error (but continuing...): {e}")
+        app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
+    else:
         print('♻️ Starting in Polling mode...')
-        bot.polling(none_stop=True)
+        start_metrics_server()
+        run_polling()